@@ -1,19 +1,28 @@
 import os
 import sys
 import imghdr
-from ffmpy import FFmpeg
-from collections import OrderedDict
-import random
+from ffmpy import FFmpeg, FFRuntimeError
+from cache import MediaCache, file_digest
+from connections import ConnectionPool
+from audiolibrary import AudioLibrary
+import frames
+import jobs
+from collections import namedtuple
 import math
 import urllib2
 import json
-import string
 import re
 import uuid
-import datetime
 import time
 import traceback
-from filters import CombiningFilter, ZoompanEffectFilter, ImageSlideFilter, FadeTransitionFilter, FilterChain, SlideTransitionFilter, ConcatFilter, ReplicateAudioFilter, TrimAudioFilter, FadeOutAudioFilter, ZoompanSlideInTransitionFilter
+import threading
+import urlparse
+import tempfile
+import struct
+import multiprocessing
+import contextlib
+from Queue import Queue
+from filters import StillImageFilter, CombiningFilter, ZoompanEffectFilter, ImageSlideFilter, FadeTransitionFilter, FilterChain, SlideTransitionFilter, ConcatFilter, ReplicateAudioFilter, LoopedAudioFilter, TrimAudioFilter, FadeOutAudioFilter, ZoompanSlideInTransitionFilter, optimize_graph
 from enum import IntEnum
 
 FPS = 25
@@ -22,8 +31,103 @@ TRANSITION_T = 0.5
 OUTPUT_VIDEO_WIDTH = 1200
 OUTPUT_VIDEO_HEIGHT = 800
 AUDIO_FADE_OUT_T = 5
-AUDIO_TRACKS_INDEX_URL = "https://s3.amazonaws.com/asapvideo/audio/tracks.json"
+# url or local path of the audio tracks index
+AUDIO_TRACKS_INDEX_URL = os.environ.get("ASAPVIDEO_AUDIO_TRACKS_INDEX", "https://s3.amazonaws.com/asapvideo/audio/tracks.json")
+AUDIO_INDEX_TTL_T = 3600
+AUDIO_TRACK_TTL_T = 24 * 3600
 MAX_ZOOM = 1.0565
+# alternating zoom (in, out) and slide (four directions) animations repeat after this number of slides
+ANIMATION_PERIOD = 4
+# zoompan renders frames from images scaled to this multiple of the output size instead of the full images,
+# higher factors give smoother motion for more time; None zooms the full images
+ZOOMPAN_OVERSAMPLE = None
+# animations (effect and transition names joined, e.g. "zoompan" or "zoompanslidein") rendered by the numpy
+# frame generator instead of ffmpeg filter graph; ignored if numpy is not installed
+FRAME_GENERATOR_ANIMATIONS = []
+# "bilinear" or "nearest" (faster, use with ZOOMPAN_OVERSAMPLE) interpolation of the frame generator zoom
+FRAME_INTERPOLATION = "bilinear"
+DOWNLOAD_CONCURRENCY = 8
+DOWNLOAD_HOST_CONCURRENCY = 4
+VALIDATION_CONCURRENCY = 16
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF_T = 0.5
+MEDIA_CACHE_DIR = os.environ.get("ASAPVIDEO_CACHE_DIR", os.path.join(tempfile.gettempdir(), "asapvideo-cache"))
+# the caches share the file system of MEDIA_CACHE_DIR with the outputs (e.g. /tmp of 512 MB on AWS Lambda), every
+# cache evicts its entries to leave at least this much free space there besides its own size limit
+CACHE_MIN_FREE_SIZE = 256 * 1024 * 1024
+MEDIA_CACHE_SIZE = 128 * 1024 * 1024
+HTTP_POOL_SIZE = 8
+HTTP_TIMEOUT_T = 30
+NORMALIZE_IMAGES = True
+# "loop" demuxes and decodes still images for every frame, "decode_once" decodes them once and repeats the frame
+STILL_INPUT_MODE = "loop"
+RENDER_PROCESSES = multiprocessing.cpu_count()
+# cores shared by the renders running at the same time and threads of the most expensive render
+RENDER_CORES = multiprocessing.cpu_count()
+RENDER_MAX_THREADS = multiprocessing.cpu_count()
+# render time in seconds of one OUTPUT_VIDEO_WIDTH x OUTPUT_VIDEO_HEIGHT frame by animation (effect and transition
+# names joined) with the default encoder profile; relative costs decide the threads of the renders
+RENDER_COSTS = {"": 0.004, "fadeinout": 0.005, "slidein": 0.011, "zoompan": 0.028, "zoompanfadeinout": 0.030, "zoompanslidein": 0.034}
+# x264 encoder profiles trading encoding speed for quality and size
+ENCODER_PROFILES = {
+    "preview": {"preset": "ultrafast", "crf": 30, "tune": "stillimage", "gop": FPS * 10, "threads": 0, "pix_fmt": "yuvj420p"},
+    "standard": {"preset": "medium", "crf": 20, "tune": "stillimage", "gop": FPS * 10, "threads": 0, "pix_fmt": "yuvj420p"},
+    "archive": {"preset": "slow", "crf": 16, "tune": "stillimage", "gop": FPS * 5, "threads": 0, "pix_fmt": "yuvj420p"}
+}
+DEFAULT_ENCODER_PROFILE = "standard"
+PREVIEW_SCALE = 0.5
+PREVIEW_FPS = 10
+CACHE_SEGMENTS = False
+# slides per cached segment, longer segments start fewer ffmpeg processes, shorter ones are reused after smaller edits
+CACHED_SEGMENT_SLIDES = 10
+SEGMENT_CACHE_SIZE = 1024 * 1024 * 1024
+AUDIO_ENCODER_OPTIONS = "-c:a aac -b:a 192k"
+AUDIO_BED_CACHE_SIZE = 128 * 1024 * 1024
+# "stream_loop" loops the audio track at constant cost, "replicate" builds one filter branch per repetition
+AUDIO_LOOP_MODE = "stream_loop"
+STREAM_CONCAT = False
+# simplify the generated filter graphs (drop no-op filters, merge linear chains) before passing them to ffmpeg
+OPTIMIZE_FILTER_GRAPH = True
+PIPELINES_SIZE = 64
+# filter graphs longer than this are passed to ffmpeg in a script file instead of the command line
+FILTER_SCRIPT_THRESHOLD = 16 * 1024
+NORMALIZED_PIX_FMT = "rgb24"
+NORMALIZED_CACHE_SIZE = 64 * 1024 * 1024
+# number of jobs submitted by the *_async functions running at the same time, the others wait in queue
+JOB_CONCURRENCY = 16
+# video filters that bring image with the given EXIF orientation to normal orientation
+ORIENTATION_FILTERS = {
+    2: ["hflip"],
+    3: ["hflip", "vflip"],
+    4: ["vflip"],
+    5: ["transpose=0"],
+    6: ["transpose=1"],
+    7: ["transpose=3"],
+    8: ["transpose=2"]
+}
+
+# downloaded media cache; set to None to disable caching
+MEDIA_CACHE = MediaCache(os.path.join(MEDIA_CACHE_DIR, "media"), MEDIA_CACHE_SIZE, CACHE_MIN_FREE_SIZE)
+# normalized images cache; set to None to disable caching
+NORMALIZED_CACHE = MediaCache(os.path.join(MEDIA_CACHE_DIR, "normalized"), NORMALIZED_CACHE_SIZE, CACHE_MIN_FREE_SIZE)
+# rendered slide segments cache; set to None to disable caching
+SEGMENT_CACHE = MediaCache(os.path.join(MEDIA_CACHE_DIR, "segments"), SEGMENT_CACHE_SIZE, CACHE_MIN_FREE_SIZE)
+# prerendered soundtracks cache; set to None to disable caching
+AUDIO_BED_CACHE = MediaCache(os.path.join(MEDIA_CACHE_DIR, "audio"), AUDIO_BED_CACHE_SIZE, CACHE_MIN_FREE_SIZE)
+# keep-alive connections shared by all network requests
+HTTP_POOL = ConnectionPool(HTTP_POOL_SIZE, HTTP_TIMEOUT_T)
+# audio tracks index loaded once per process
+AUDIO_LIBRARY = AudioLibrary(AUDIO_TRACKS_INDEX_URL, HTTP_POOL, AUDIO_INDEX_TTL_T)
+# video filter chains already built by animation, size and duration
+PIPELINES = {}
+# sizes of the optimized filter graphs before and after the optimization summed over all renders
+GRAPH_STATS = {"graphs": 0, "before": {}, "after": {}}
+GRAPH_STATS_LOCK = threading.Lock()
+# executor of the jobs submitted by the *_async functions
+JOBS = jobs.JobExecutor(JOB_CONCURRENCY)
+# scheduler sharing the cores among the renders running at the same time; set to None to let every render use all
+RENDER_SCHEDULER = jobs.RenderScheduler(RENDER_CORES, RENDER_MAX_THREADS)
 
 """
     Batch modes enumerator.
@@ -35,9 +139,9 @@ class BatchMode(IntEnum):
 
 
 """
-    Receives list of urls and returns the valid ones.
+    Builds the regular expression used for recognising correct urls.
 """
-def get_valid_media_urls_only(list, content_type = None):
+def _compile_url_regex():
     regex = r'('
     # Scheme (HTTP, HTTPS, FTP and SFTP):
     regex += r'(?:(https?|s?ftp):\/\/)?'
@@ -56,271 +160,789 @@ def get_valid_media_urls_only(list, content_type = None):
     # Query path:
     regex += r'(?:(\/\S+)*)'
     regex += r')'
-    prog = re.compile(regex, re.IGNORECASE)
+    return re.compile(regex, re.IGNORECASE)
+
+URL_REGEX = _compile_url_regex()
+
+
+"""
+    Result of media url validation.
+"""
+MediaInfo = namedtuple("MediaInfo", ["url", "final_url", "status", "content_type", "content_length", "etag", "last_modified"])
 
+
+"""
+    Receives list of urls and returns the valid ones.
+"""
+def get_valid_media_urls_only(list, content_type = None, concurrency = VALIDATION_CONCURRENCY):
     # add all urls that are recognised as correct, return status code 200 and image content type
-    result = []
-    for u in [u for u in list if prog.match(u)]:
+    return [i.final_url for i in probe_media_urls(list, content_type, concurrency) if i != None]
+
+
+"""
+    Validates all urls from the list concurrently using header only requests. Returns MediaInfo for every
+    valid url and None for every invalid one in the order of the passed urls.
+"""
+def probe_media_urls(list, content_type = None, concurrency = VALIDATION_CONCURRENCY):
+    results = _run_parallel(lambda u: _probe_media_url(u) if URL_REGEX.match(u) else None, list, concurrency, DOWNLOAD_HOST_CONCURRENCY, key = _get_host)
+    return [i if i != None and i.status == 200 and (content_type == None or (i.content_type or "").startswith(content_type)) else None for i, e in results]
+
+
+"""
+    Private method that reads the headers of single url. It tries HEAD request first, then single byte range GET request
+    and finally plain GET request for servers that do not support the former ones. The body is never read.
+"""
+def _probe_media_url(url):
+    for method, headers in [("HEAD", {}), ("GET", {"Range": "bytes=0-0"}), ("GET", {})]:
+        r = None
         try:
-            r = urllib2.urlopen(u)
-            if r.getcode() == 200 and (content_type == None or r.info().getheader('Content-Type').startswith(content_type)):
-                result.append(r.geturl())
+            r = HTTP_POOL.urlopen(url, headers, method)
+            info = r.info()
+            status = r.getcode()
+            length = info.getheader('Content-Length')
+            if status == 206:
+                # the total length of partial response is found in the content range header
+                content_range = info.getheader('Content-Range') or ""
+                length = content_range.split("/")[-1] if "/" in content_range else None
+                status = 200
+            return MediaInfo(
+                url = url,
+                final_url = r.geturl(),
+                status = status,
+                content_type = info.getheader('Content-Type'),
+                content_length = int(length) if length and length.isdigit() else None,
+                etag = info.getheader('ETag'),
+                last_modified = info.getheader('Last-Modified'))
+        except urllib2.HTTPError as e:
+            # the resource is missing, so there is no point to try other methods
+            if e.code in (404, 410): return None
         except:
             pass
+        finally:
+            if r: r.close()
+    return None
 
-    return result
-    
 
 """
-    Creates video from all image files found in the passed directory.
+    Creates video from all image files found in the passed directory. Progress, if passed, is called with
+    the progress events reported by ffmpeg while the video is encoded (see FFmpeg.run).
 """
-def make_from_dir(dir, scene_duration = SCENE_DURATION_T, outdir=dir, ffmpeg='ffmpeg', width=None, height=None, audio=True, effect=None, transition=None, batch_mode=BatchMode.none):
+def make_from_dir(dir, scene_duration = SCENE_DURATION_T, outdir=dir, ffmpeg='ffmpeg', width=None, height=None, audio=True, effect=None, transition=None, batch_mode=BatchMode.none, normalize=NORMALIZE_IMAGES, still_input=STILL_INPUT_MODE, parallel=False, cache_segments=CACHE_SEGMENTS, profile=DEFAULT_ENCODER_PROFILE, preview=False, progress=None):
     # add all image files in the folder as input
-    return _make([ff for ff in [os.path.join(dir,f) for f in os.listdir(dir)] if imghdr.what(ff) != None], scene_duration, outdir, ffmpeg, width, height, audio, effect, transition, batch_mode)
+    return _make([ff for ff in [os.path.join(dir,f) for f in os.listdir(dir)] if imghdr.what(ff) != None], scene_duration, outdir, ffmpeg, width, height, audio, effect, transition, batch_mode, normalize, still_input, parallel, cache_segments, profile, preview, progress = progress)
 
 
 """
     Creates video from all urls passed as a url list.
 """
-def make_from_url_list(list, scene_duration = SCENE_DURATION_T, outdir=None, ffmpeg='ffmpeg', width=None, height=None, audio=True, effect=None, transition=None, batch_mode=BatchMode.none):
+def make_from_url_list(list, scene_duration = SCENE_DURATION_T, outdir=None, ffmpeg='ffmpeg', width=None, height=None, audio=True, effect=None, transition=None, batch_mode=BatchMode.none, normalize=NORMALIZE_IMAGES, still_input=STILL_INPUT_MODE, parallel=False, cache_segments=CACHE_SEGMENTS, profile=DEFAULT_ENCODER_PROFILE, preview=False, progress=None):
     dir = outdir if outdir else os.path.dirname(os.path.realpath(__file__))
-    l = _download_file_list(list, dir)
-    return _make(l, scene_duration, dir, ffmpeg, width, height, audio, effect, transition, batch_mode)
+    # the first image of non initial batch only continues the previous batch, it could not be replaced by the next one
+    l = _download_file_list(list, dir, skip_failed = True, required = 1 if batch_mode == BatchMode.non_initial_batch else 0)
+    return _make(l, scene_duration, dir, ffmpeg, width, height, audio, effect, transition, batch_mode, normalize, still_input, parallel, cache_segments, profile, preview, progress = progress)
 
 
 """
     Private method for creating video from list of local image files.
 """
-def _make(images, scene_duration, dir, ffmpeg, width, height, audio, effect, transition, batch_mode):
+def _make(images, scene_duration, dir, ffmpeg, width, height, audio, effect, transition, batch_mode, normalize=False, still_input=STILL_INPUT_MODE, parallel=False, cache_segments=False, profile=DEFAULT_ENCODER_PROFILE, preview=False, output=None, prescaled=False, fps=FPS, progress=None, offset=0, threads=None, preserve_last=True):
     # exit if no images were found
     if bool(images) == False:
         return None
 
-    scene_duration_f = scene_duration * FPS
     w = width/2*2 if width != None else -2 if height != None else OUTPUT_VIDEO_WIDTH
     h = height/2*2 if height != None else -2 if width != None else OUTPUT_VIDEO_HEIGHT
 
-    # build the animation dictionary of filters and first slide handling flag
+    # preview has the same timeline, but it is rendered at lower resolution, frame rate and encoder effort
+    if preview == True:
+        w = int(w * PREVIEW_SCALE)/2*2 if w > 0 else w
+        h = int(h * PREVIEW_SCALE)/2*2 if h > 0 else h
+        width, height, fps, profile = w, h, PREVIEW_FPS, "preview"
+        output = output if output else os.path.normpath(os.path.join(dir, "preview.mp4"))
+
+    # decode, orient and resize every image once instead of scaling it on every frame, oversampled zoompan crops
+    # images of the oversampled size, the other filters scale them to the output size then
+    if normalize == True:
+        oversample = ZOOMPAN_OVERSAMPLE if effect == "zoompan" and ZOOMPAN_OVERSAMPLE and w > 0 and h > 0 else None
+        if oversample:
+            images = _normalize_images(images, int(w * oversample)/2*2, int(h * oversample)/2*2, dir, ffmpeg)
+        else:
+            images = _normalize_images(images, w, h, dir, ffmpeg)
+        prescaled = oversample == None
+
+    # split the slideshow into segments rendered side by side, cached segments have CACHED_SEGMENT_SLIDES slides
+    if parallel == True or cache_segments == True:
+        return _make_parallel(images, scene_duration, dir, ffmpeg, width, height, audio, effect, transition, batch_mode, prescaled, still_input, profile, fps, CACHED_SEGMENT_SLIDES if cache_segments == True else None, output, progress, offset, preserve_last)
+
+    # the filter chain generating the whole video graph is built once per animation and size
+    videoseq, preserve_first_slide = _get_pipeline(effect, transition, scene_duration, w, h, fps, batch_mode != BatchMode.non_initial_batch, prescaled, still_input, preserve_last)
+
+    # determines how to interpret the inputs list
+    if batch_mode != BatchMode.non_initial_batch:
+        slides = images
+    elif preserve_first_slide:
+        slides = images
+    else:
+        slides = images[1:]
+    lenght_t = _get_video_t(len(images) - (1 if batch_mode == BatchMode.non_initial_batch else 0), scene_duration, effect, transition, preserve_last)
+    # index of the first slide in the whole slideshow, the alternating animations continue from it
+    offset += len(images) - len(slides)
+               
+    if _use_frame_generator(effect, transition):
+        # the frames are rendered in python and piped to the encoder as raw video
+        generator = frames.FrameGenerator(w, h, fps, ffmpeg, ZOOMPAN_OVERSAMPLE or 1, FRAME_INTERPOLATION)
+        video_frames = generator.generate(slides, (effect if effect else "") + (transition if transition else ""), scene_duration, TRANSITION_T, MAX_ZOOM, batch_mode != BatchMode.non_initial_batch, offset, preserve_last)
+        inputs = [("-", generator.get_input_options())]
+        applied_filters = None
+        video_map = "0:v"
+    else:
+        # the same image could be used by more than one slide, so inputs are kept as list instead of dictionary
+        inputs = [(i, "-loop 1 -framerate %d" % fps if still_input == "loop" else None) for i in slides]
+
+        # generate the video filter graph
+        applied_filters = videoseq.generate(["%d:v" % i for (i,x) in enumerate(inputs)], offset)[0]
+        if OPTIMIZE_FILTER_GRAPH == True:
+            applied_filters = _optimize_graph(applied_filters, ["video"])
+        video_frames = None
+        video_map = "[video]"
+    
+    # load prerendered audio bed if requested, it is muxed without filtering or encoding
+    if audio == True:
+        inputs.append((_get_audio_bed(lenght_t, dir, ffmpeg), None))
+
+    # build the video
+    if output == None:
+        output = "video.mp4"
+        output = dir + "/" + output if dir else output
+    with _render_slot(effect, transition, w, h, threads) as threads:
+        ff = FFmpeg(
+            executable = ffmpeg,
+            global_options = ["-y"] + (["-filter_complex_threads", str(threads)] if threads and applied_filters else []),
+            inputs = inputs,
+            outputs = {output: "-map \"%s\"" % video_map + (" -map %d:a -c:a copy" % (len(inputs) - 1) if audio == True else "") + " " + _get_encoder_options(profile, threads)},
+            filter_complex = applied_filters,
+            filter_script = _get_filter_script(applied_filters, dir) if applied_filters else None
+        )
+        #print ff.cmd
+        ff.run(input_data = video_frames, progress = progress)
+    return output
+
+
+"""
+    Returns render time in seconds of one frame of the requested animation and size estimated from RENDER_COSTS.
+    Sizes preserving aspect ratio (-2) are estimated as the default output size.
+"""
+def get_render_cost(effect, transition, width, height):
+    cost = RENDER_COSTS.get((effect if effect else "") + (transition if transition else ""), max(RENDER_COSTS.values()))
+    if width > 0 and height > 0:
+        cost *= float(width * height) / (OUTPUT_VIDEO_WIDTH * OUTPUT_VIDEO_HEIGHT)
+    return cost
+
+
+"""
+    Private method that returns the duration in seconds of video of count rendered slides. Zoompan slide in ends
+    with the last slide zooming out for TRANSITION_T, unless preserve_last is False (the video is continued).
+"""
+def _get_video_t(count, scene_duration, effect, transition, preserve_last = True):
+    tail = TRANSITION_T if preserve_last and (effect if effect else "") + (transition if transition else "") == "zoompanslidein" else 0
+    return scene_duration * count + tail
+
+
+"""
+    Private method that waits for RENDER_SCHEDULER slot of the render and yields the number of threads it gets, None
+    if the renders are not scheduled. The cost of the render is relative to the most expensive animation. Renders
+    passing threads already run in the slot of their parent (e.g. segments of parallel render) and do not wait.
+"""
+@contextlib.contextmanager
+def _render_slot(effect, transition, width, height, threads = None):
+    if RENDER_SCHEDULER == None or threads != None:
+        yield threads
+        return
+    with RENDER_SCHEDULER.slot(get_render_cost(effect, transition, width, height) / max(RENDER_COSTS.values())) as threads:
+        yield threads
+
+
+"""
+    Private method that checks if the animation should be rendered by the frame generator.
+"""
+def _use_frame_generator(effect, transition):
+    return frames.numpy != None and (effect if effect else "") + (transition if transition else "") in FRAME_GENERATOR_ANIMATIONS
+
+
+"""
+    Private method that returns (filter chain, first slide handling flag) tuple for the requested animation. The chain
+    generates the whole video graph for any number of inputs and keeps no state, so it is built once per animation,
+    size and duration and reused by all the following videos.
+"""
+def _get_pipeline(effect, transition, scene_duration, w, h, fps, preserve_first, prescaled, still_input, preserve_last = True):
+    key = (effect, transition, scene_duration, w, h, fps, preserve_first, preserve_last, prescaled, still_input, MAX_ZOOM, TRANSITION_T, ZOOMPAN_OVERSAMPLE)
+    pipeline = PIPELINES.get(key)
+    if pipeline == None:
+        pipeline = _build_pipeline(effect, transition, scene_duration, w, h, fps, preserve_first, prescaled, still_input, preserve_last)
+        if len(PIPELINES) >= PIPELINES_SIZE: PIPELINES.clear()
+        PIPELINES[key] = pipeline
+    return pipeline
+
+
+def _build_pipeline(effect, transition, scene_duration, w, h, fps, preserve_first, prescaled, still_input, preserve_last = True):
+    scene_duration_f = scene_duration * fps
+
+    # animation dictionary of filter builders and first slide handling flags, only the requested one is built
     animations = {
-        "zoompan": (
+        "zoompan": lambda: (
             CombiningFilter(
                 [
-                    ZoompanEffectFilter(maxzoom = MAX_ZOOM, frames = scene_duration_f),
+                    ZoompanEffectFilter(maxzoom = MAX_ZOOM, frames = scene_duration_f, fps = fps, width = w, height = h, oversample = ZOOMPAN_OVERSAMPLE),
                     ImageSlideFilter(duration = scene_duration, width = w, height = h)
                 ],
                 outstreamprefix = "zpaf"),
             False
         ),
-        "fadeinout": (
+        "fadeinout": lambda: (
             CombiningFilter([
                     FadeTransitionFilter(transition_duration = TRANSITION_T, total_duration = scene_duration),
-                    ImageSlideFilter(duration = scene_duration, width = w, height = h)
+                    ImageSlideFilter(duration = scene_duration, width = w, height = h, prescaled = prescaled)
                 ],
                 outstreamprefix = "faf"),
             False
         ),
-        "zoompanfadeinout": (
+        "zoompanfadeinout": lambda: (
             CombiningFilter(
                 [
-                    ZoompanEffectFilter(maxzoom = MAX_ZOOM, frames = scene_duration_f),
+                    ZoompanEffectFilter(maxzoom = MAX_ZOOM, frames = scene_duration_f, fps = fps, width = w, height = h, oversample = ZOOMPAN_OVERSAMPLE),
                     FadeTransitionFilter(transition_duration = TRANSITION_T, total_duration = scene_duration),
                     ImageSlideFilter(duration = scene_duration, width = w, height = h)
                 ],
                 outstreamprefix = "zpfaf"),
             False
         ),
-        "slidein": (
+        "slidein": lambda: (
             FilterChain(
                 [
-                    ImageSlideFilter(duration = scene_duration, width = w, height = h),
-                    SlideTransitionFilter(transition_duration = TRANSITION_T, preserve_first = batch_mode != BatchMode.non_initial_batch)
+                    ImageSlideFilter(duration = scene_duration, width = w, height = h, prescaled = prescaled),
+                    SlideTransitionFilter(transition_duration = TRANSITION_T, preserve_first = preserve_first)
                 ]),
             True
         ),
-        "zoompanslidein": (
-            ZoompanSlideInTransitionFilter(transition_duration = TRANSITION_T, total_duration = scene_duration, fps = FPS, width = w, height = h, maxzoom = MAX_ZOOM, preserve_first = batch_mode != BatchMode.non_initial_batch),
+        "zoompanslidein": lambda: (
+            ZoompanSlideInTransitionFilter(transition_duration = TRANSITION_T, total_duration = scene_duration, fps = fps, width = w, height = h, maxzoom = MAX_ZOOM, preserve_first = preserve_first, prescaled = prescaled, oversample = ZOOMPAN_OVERSAMPLE, preserve_last = preserve_last),
             True
         )
     }
     animationkey = (effect if effect else "") + (transition if transition else "")
-    animation = animations[animationkey] if animationkey in animations else None
-
-    # determines if transition is requested and how to interpret the inputs list
-    preserve_first_slide = animation[1] if animation else False
-    if batch_mode != BatchMode.non_initial_batch:
-        slides = images
-        lenght_t = scene_duration * len(slides)
-    elif preserve_first_slide:
-        slides = images
-        lenght_t = scene_duration * (len(slides) - 1)
-    else:
-        slides = images[1:]
-        lenght_t = scene_duration * len(slides)
-               
-    inputs = OrderedDict([(i, "-loop 1") for i in slides])
+    animation = animations[animationkey]() if animationkey in animations else None
 
-    # create the video filter chain
-    videoseq = FilterChain()
+    filters = []
+    if still_input == "decode_once":
+        filters.append(StillImageFilter(fps))
     if animation: 
-        videoseq.append(animation[0])
+        filters.append(animation[0])
     else:
-        videoseq.append(ImageSlideFilter(duration = scene_duration, width = w, height = h))
-    videoseq.append(ConcatFilter(True, "video"))
-    applied_filters = videoseq.generate(["%d:v" % i for (i,x) in enumerate(inputs)])[0]
-    
-    # load audio track if requested
-    if audio == True:
-        audio_track = _get_audio(lenght_t, dir)
-        # build the filter chain and execute it
-        audioseq = FilterChain([
-            ReplicateAudioFilter(repetitions = int(math.ceil(lenght_t / float(audio_track[1])))), 
-            ConcatFilter(is_video = False, outputtag = "caf"),
-            TrimAudioFilter(length = lenght_t),
-            FadeOutAudioFilter(start = lenght_t-AUDIO_FADE_OUT_T, length = AUDIO_FADE_OUT_T, outstreamprefix="audio")
-        ])
-        applied_filters += audioseq.generate(["%d:a" % len(inputs)])[0]
-        # add the audio track to the inputs collection
-        inputs.update({audio_track[0]: None})
+        filters.append(ImageSlideFilter(duration = scene_duration, width = w, height = h, prescaled = prescaled))
+    filters.append(ConcatFilter(True, "video"))
+    return FilterChain(filters), animation[1] if animation else False
 
-    # build the video
-    output = "video.mp4"
-    output = dir + "/" + output if dir else output
+
+"""
+    Private method that splits the slideshow into RENDER_PROCESSES segments (or segments of segment_size slides),
+    renders them by separate ffmpeg processes at the same time and joins them by stream copy. Segments overlap by
+    one image and are rendered as non initial batches, so transitions between them are preserved. All segments
+    share the encoder options of _make, so they could be concatenated without re-encoding. When segment_size is
+    passed segments are looked up in SEGMENT_CACHE first and only the missing ones are rendered. Progress is
+    reported only for the final join, progress of the segments rendered at the same time would interleave.
+    Segments get the index of their first image, so the alternating animations continue as in single render, and
+    only the last segment ends the last slide, the others are continued by the next segment.
+    All segments run in single RENDER_SCHEDULER slot and split its threads.
+"""
+def _make_parallel(images, scene_duration, dir, ffmpeg, width, height, audio, effect, transition, batch_mode, prescaled, still_input, profile, fps, segment_size = None, output = None, progress = None, offset = 0, preserve_last = True):
+    count = max(1, min(RENDER_PROCESSES, len(images)))
+    size = segment_size if segment_size else int(math.ceil(len(images) / float(count)))
+    # transitions need at least two slides in the initial segment
+    first = max(size, 2) if transition else size
+    bounds = [0] + range(first, len(images), size) + [len(images)]
+    segments = []
+    for b, e in zip(bounds, bounds[1:]):
+        segments.append((
+            images[max(b-1, 0):e],
+            batch_mode if b == 0 else BatchMode.non_initial_batch,
+            os.path.normpath(os.path.join(dir, "segment-%s.mp4" % str(uuid.uuid4()))),
+            offset + max(b-1, 0),
+            preserve_last and e == len(images)))
+
+    # images are already normalized, so the segments are rendered straight from them
+    cache = SEGMENT_CACHE if segment_size else None
+    with _render_slot(effect, transition, width, height) as threads:
+        threads = max(1, threads / min(RENDER_PROCESSES, len(segments))) if threads else None
+        results = _run_parallel(lambda s: _make_segment(s, scene_duration, dir, ffmpeg, width, height, effect, transition, prescaled, still_input, profile, fps, cache, threads), segments, RENDER_PROCESSES)
+    for result, error in results:
+        if error != None: raise error
+    # durations of the segments are known, non initial segments do not render their first image
+    durations = [_get_video_t(len(s[0]) - (1 if s[1] == BatchMode.non_initial_batch else 0), scene_duration, effect, transition, s[4]) for s in segments]
+    return _concat([r[0] for r in results], dir, ffmpeg, audio, durations, output, progress)
+
+
+"""
+    Private method that renders single segment without audio or takes it from the cache if passed.
+"""
+def _make_segment(segment, scene_duration, dir, ffmpeg, width, height, effect, transition, prescaled, still_input, profile, fps, cache, threads = None):
+    images, batch_mode, output, offset, preserve_last = segment
+    key = json.dumps([[file_digest(i) for i in images], int(batch_mode), offset % ANIMATION_PERIOD, preserve_last, effect, transition, scene_duration, width, height, MAX_ZOOM, ZOOMPAN_OVERSAMPLE, _use_frame_generator(effect, transition) and FRAME_INTERPOLATION, fps, TRANSITION_T, _get_encoder_options(profile)]) if cache else None
+    cached = cache.get(key, dir = dir) if cache else None
+    if cached:
+        cache.add("saved_t", cached[1].get("render_t", 0))
+        return cached[0]
+
+    t = time.time()
+    output = _make(images, scene_duration, dir, ffmpeg, width, height, False, effect, transition, batch_mode, False, still_input, profile = profile, output = output, prescaled = prescaled, fps = fps, offset = offset, threads = threads, preserve_last = preserve_last)
+    if output != None and cache:
+        return cache.put(key, output, {"render_t": time.time() - t}, dir)
+    return output
+
+
+"""
+    Returns statistics of all caches, including hit ratios and the render time saved by cached segments.
+"""
+def get_cache_stats():
+    return dict([(name, cache.stats()) for name, cache in [("media", MEDIA_CACHE), ("normalized", NORMALIZED_CACHE), ("segments", SEGMENT_CACHE), ("audio", AUDIO_BED_CACHE)] if cache])
+
+
+"""
+    Returns the number of optimized filter graphs and the total numbers of their filters (nodes), links (edges)
+    and chains before and after the optimization.
+"""
+def get_graph_stats():
+    with GRAPH_STATS_LOCK:
+        return {"graphs": GRAPH_STATS["graphs"], "before": dict(GRAPH_STATS["before"]), "after": dict(GRAPH_STATS["after"])}
+
+
+"""
+    Private method that optimizes the filter graph preserving the labels in keep and adds its statistics to
+    GRAPH_STATS.
+"""
+def _optimize_graph(filters, keep):
+    chains, stats = optimize_graph(filters, keep)
+    with GRAPH_STATS_LOCK:
+        GRAPH_STATS["graphs"] += 1
+        for k in ["before", "after"]:
+            for name, value in stats[k].items():
+                GRAPH_STATS[k][name] = GRAPH_STATS[k].get(name, 0) + value
+    return chains
+
+
+"""
+    Returns ffmpeg video encoder options of the named encoder profile. Unknown profiles fall back to the default one.
+    Threads, if passed, override the threads of the profile.
+"""
+def _get_encoder_options(profile, threads = None):
+    p = dict(ENCODER_PROFILES.get(profile, ENCODER_PROFILES[DEFAULT_ENCODER_PROFILE]))
+    if threads: p["threads"] = threads
+    options = "-c:v libx264 -preset {preset} -crf {crf} -g {gop} -threads {threads} -pix_fmt {pix_fmt}".format(**p)
+    return options + (" -tune " + p["tune"] if p["tune"] else "")
+
+
+"""
+    Normalizes all images concurrently. See _normalize_image.
+"""
+def _normalize_images(images, width, height, dir, ffmpeg):
+    results = _run_parallel(lambda i: _normalize_image(i, width, height, dir, ffmpeg), images, multiprocessing.cpu_count())
+    for result, error in results:
+        if error != None: raise error
+    return [r[0] for r in results]
+
+
+"""
+    Private method that decodes the image once, applies its EXIF orientation, resizes it to the output size and
+    converts it to NORMALIZED_PIX_FMT. Normalized images are cached by their content and the output size.
+"""
+def _normalize_image(image, width, height, dir, ffmpeg):
+    key = "%s:%dx%d" % (file_digest(image), width, height)
+    cached = NORMALIZED_CACHE.get(key, dir = dir) if NORMALIZED_CACHE else None
+    if cached:
+        return cached[0]
+
+    filters = ORIENTATION_FILTERS.get(_get_exif_orientation(image), []) + ["scale=%d:%d" % (width, height), "setsar=1", "format=" + NORMALIZED_PIX_FMT]
+    output = os.path.normpath(os.path.join(dir, str(uuid.uuid4()) + ".png"))
     ff = FFmpeg(
         executable = ffmpeg,
         global_options = ["-y"],
-        inputs = inputs,
-        outputs = {output: "-filter_complex \"" + ";".join(applied_filters) + "\" -map \"[video]\"" + (" -map \"[audio]\"" if audio == True else "") + " -c:v libx264 -pix_fmt yuvj420p -q:v 1"}
-	)
-    #print ff.cmd
+        inputs = {image: "-noautorotate"},
+        outputs = {output: "-vf \"" + ",".join(filters) + "\" -frames:v 1"}
+    )
     ff.run()
-    return output
+    return NORMALIZED_CACHE.put(key, output, dir = dir) if NORMALIZED_CACHE else output
+
+
+"""
+    Private method that reads EXIF orientation tag of JPEG image. Returns 1 (normal) if the tag is not present.
+"""
+def _get_exif_orientation(image):
+    try:
+        with open(image, "rb") as f:
+            if f.read(2) != "\xff\xd8":
+                return 1
+            while True:
+                marker, size = struct.unpack(">2sH", f.read(4))
+                if marker[0] != "\xff" or marker[1] in ("\xda", "\xd9"):
+                    return 1
+                data = f.read(size - 2)
+                if marker[1] == "\xe1" and data[0:6] == "Exif\x00\x00":
+                    break
+        tiff = data[6:]
+        endian = "<" if tiff[0:2] == "II" else ">"
+        ifd = struct.unpack(endian + "I", tiff[4:8])[0]
+        count = struct.unpack(endian + "H", tiff[ifd:ifd + 2])[0]
+        for i in range(0, count):
+            entry = tiff[ifd + 2 + i * 12:ifd + 14 + i * 12]
+            if struct.unpack(endian + "H", entry[0:2])[0] == 0x0112:
+                return struct.unpack(endian + "H", entry[8:10])[0]
+    except (IOError, struct.error, IndexError):
+        pass
+    return 1
 
 
 """
-    Concatenates all video files passed as a url list.
+    Concatenates all video files passed as a url list. If durations of the videos are known they could be passed
+    to save probing the files. In stream mode the videos are not downloaded first, but read by ffmpeg directly
+    from their urls while muxing, so only the output is stored locally. Progress callback receives the progress
+    events of ffmpeg while muxing.
 """
-def concat_videos(list, outdir=None, ffmpeg='ffmpeg', audio=True):
+def concat_videos(list, outdir=None, ffmpeg='ffmpeg', audio=True, durations=None, stream=STREAM_CONCAT, progress=None):
     dir = outdir if outdir else os.path.dirname(os.path.realpath(__file__))
-    videos = _download_file_list(list, dir)
+    if stream == True:
+        videos = [u for u in list]
+    else:
+        # batch outputs are used only once, so they are not worth caching
+        videos = _download_file_list(list, dir, cache = False)
     if bool(videos) == False:
         return None
-    
+    return _concat(videos, dir, ffmpeg, audio, durations, progress = progress)
+
+
+"""
+    Asynchronous counterparts of make_from_dir, make_from_url_list and concat_videos. They accept the same
+    arguments, submit the work to JOBS and return jobs.Job immediately. Job.result waits for the output and
+    Job.cancel stops the downloads and kills the ffmpeg processes of the job.
+"""
+def make_from_dir_async(*args, **kwargs):
+    return JOBS.submit(make_from_dir, *args, **kwargs)
+
+
+def make_from_url_list_async(*args, **kwargs):
+    return JOBS.submit(make_from_url_list, *args, **kwargs)
+
+
+def concat_videos_async(*args, **kwargs):
+    return JOBS.submit(concat_videos, *args, **kwargs)
+
+
+"""
+    Private method that concatenates local video files without re-encoding them and applies soundtrack if requested.
+    The videos and the prerendered audio bed are muxed by stream copy in a single pass.
+"""
+def _concat(videos, dir, ffmpeg, audio, durations = None, output = None, progress = None):
     # make the video files list
     file_name = os.path.normpath(os.path.join(dir, str(uuid.uuid4())))
     with open(file_name, 'w') as file:
         for video in videos:
-            file.write("file '" + video + "'\n")
+            # single quotes in paths and urls are escaped as the concat demuxer expects
+            file.write("file '" + video.replace("'", "'\\''") + "'\n")
+    inputs = [(file_name, ["-f" ,"concat", "-safe", "0", "-protocol_whitelist", "file,http,https,tcp,tls"])]
+
+    # if audio background is requested the audio bed matching the total duration is added to the inputs
+    if audio == True:
+        lenght_t = sum(durations) if durations else sum([get_duration(v, ffmpeg) for v in videos])
+        inputs.append((_get_audio_bed(lenght_t, dir, ffmpeg), None))
 
     # concatenate the videos
-    output = os.path.normpath(os.path.join(dir, "video.mp4"))
+    output = output if output else os.path.normpath(os.path.join(dir, "video.mp4"))
     ff = FFmpeg(
         executable = ffmpeg,
-        global_options = ["-y", "-f" ,"concat", "-safe", "0", "-protocol_whitelist", "file,http,https,tcp,tls"],
-        inputs = {file_name: None},
-        outputs = {output: "-c copy"}
+        global_options = ["-y"],
+        inputs = inputs,
+        outputs = {output: "-map 0:v" + (" -map 1:a" if audio == True else "") + " -c copy"}
 	)
     #print ff.cmd
-    out = ff.run()
+    ff.run()
+    return output
 
-    # if audio background is requested we will try to get duration of movie and matching audio file
-    if audio == True:
-        # collect data for concatenated movie total duration
-        length = time.strptime(re.findall("(?<=time\\=)[0-9.:]+", out)[-1],"%H:%M:%S.%f")
-        lenght_t = datetime.timedelta(hours=length.tm_hour,minutes=length.tm_min,seconds=length.tm_sec).total_seconds()
-        inputs = OrderedDict([(output, None)])
-        applied_filters = ["[0:v]null[video]"]
-        audio_track = _get_audio(lenght_t, dir)
-        # build the filter chain and execute it
-        audioseq = FilterChain([
-            ReplicateAudioFilter(repetitions = int(math.ceil(lenght_t / float(audio_track[1])))), 
+
+"""
+    Private method that returns path of the file the filter graph is passed in if it is too long for the command
+    line or None if it could be passed as argument.
+"""
+def _get_filter_script(filters, dir):
+    if sum([len(f) + 1 for f in filters]) <= FILTER_SCRIPT_THRESHOLD:
+        return None
+    return os.path.normpath(os.path.join(dir or tempfile.gettempdir(), str(uuid.uuid4()) + ".filters"))
+
+
+"""
+    Reads the duration of media file in seconds from its container metadata.
+"""
+def get_duration(file, ffmpeg = 'ffmpeg'):
+    try:
+        # ffmpeg prints the input information and fails as no output is passed
+        out = FFmpeg(executable = ffmpeg, inputs = {file: None}).run()
+    except FFRuntimeError as e:
+        out = str(e)
+    h, m, s = re.findall("Duration: (\\d+):(\\d+):([0-9.]+)", out)[0]
+    return int(h) * 3600 + int(m) * 60 + float(s)
+
+
+"""
+    Private method that returns AAC encoded soundtrack with the desired length and fade out. The track is looped,
+    trimmed and faded once and the result is kept in AUDIO_BED_CACHE by track content, length and fade out.
+"""
+def _get_audio_bed(lenght, outdir, ffmpeg):
+    audio_track = _get_audio(lenght, outdir)
+    key = json.dumps([file_digest(audio_track[0]), round(lenght, 3), AUDIO_FADE_OUT_T, AUDIO_ENCODER_OPTIONS, AUDIO_LOOP_MODE])
+    cached = AUDIO_BED_CACHE.get(key, dir = outdir) if AUDIO_BED_CACHE else None
+    if cached:
+        return cached[0]
+
+    output = os.path.normpath(os.path.join(outdir, str(uuid.uuid4()) + ".m4a"))
+    ff = _audio_bed_ffmpeg(audio_track, lenght, output, ffmpeg, AUDIO_LOOP_MODE)
+    ff.run()
+    return AUDIO_BED_CACHE.put(key, output, dir = outdir) if AUDIO_BED_CACHE else output
+
+
+"""
+    Private method that builds ffmpeg command rendering the audio bed. Loop mode "stream_loop" loops the track on the
+    input and cuts it at the desired length, while "replicate" concatenates one copy of the track per repetition.
+"""
+def _audio_bed_ffmpeg(audio_track, lenght, output, ffmpeg, loop_mode):
+    if loop_mode == "replicate":
+        loop = [
+            ReplicateAudioFilter(repetitions = int(math.ceil(lenght / float(audio_track[1])))), 
             ConcatFilter(is_video = False, outputtag = "caf"),
-            TrimAudioFilter(length = lenght_t),
-            FadeOutAudioFilter(start = lenght_t-AUDIO_FADE_OUT_T, length = AUDIO_FADE_OUT_T, outstreamprefix="audio")
-        ])
-        applied_filters += audioseq.generate(["1:a"])[0]
-        # add the audio track to the inputs collection
-        inputs.update({audio_track[0]: None})
-
-        # build the video
-        output = os.path.normpath(os.path.join(dir, "videoa.mp4"))
-        ff = FFmpeg(
-            executable = ffmpeg,
-            global_options = ["-y"],
-            inputs = inputs,
-            outputs = {output: "-filter_complex \"" + ";".join(applied_filters) + "\" -map \"[video]\" -map \"[audio]\""}
-	    )
-        #print ff.cmd
-        ff.run()
+            TrimAudioFilter(length = lenght)
+        ]
+        input_options = None
+    else:
+        loop = [LoopedAudioFilter(length = lenght)]
+        input_options = LoopedAudioFilter.input_options
 
-    return output
+    # build the filter chain
+    audioseq = FilterChain(loop + [FadeOutAudioFilter(start = lenght-AUDIO_FADE_OUT_T, length = AUDIO_FADE_OUT_T, outstreamprefix="audio")])
+    applied_filters = audioseq.generate(["0:a"])[0]
+    if OPTIMIZE_FILTER_GRAPH == True:
+        applied_filters = _optimize_graph(applied_filters, ["audio"])
+    return FFmpeg(
+        executable = ffmpeg,
+        global_options = ["-y"],
+        inputs = {audio_track[0]: input_options},
+        outputs = {output: "-map \"[audio]\" " + AUDIO_ENCODER_OPTIONS},
+        filter_complex = applied_filters,
+        filter_script = _get_filter_script(applied_filters, os.path.dirname(output))
+    )
 
 
 """
-    Private method that gets audio track from the AUDIO_TRACKS_INDEX_URL audio library by desired length.
+    Private method that gets audio track from the AUDIO_LIBRARY by desired length. Tracks are kept in the media
+    cache and are not revalidated for AUDIO_TRACK_TTL_T seconds.
 """
 def _get_audio(lenght, outdir):
     try:
-        # loads the index from url
-        r = urllib2.urlopen(AUDIO_TRACKS_INDEX_URL)
-        content = ""
-        while True:
-            data = r.read()
-            if not data: break
-            content += data
-        audio_tracks_index = json.loads(content.translate(None, string.whitespace))
-        # extracts all suitable tracks
-        audio_tracks = [(t["url"], t["length"]) for t in audio_tracks_index["tracks"] if (t["type"] == "track" and t["length"] <= lenght) or t["type"] == "loop"]
-        random.shuffle(audio_tracks)
-        track = next(iter(audio_tracks)) 
-        return (_download_file((track[0], outdir)), track[1])
+        track = AUDIO_LIBRARY.select(lenght)
+        return (_download_file_list([track[0]], outdir, max_age = AUDIO_TRACK_TTL_T)[0], track[1])
     except:
         # if we fail to select audio track we log error message and continue
         print("Failed to select audio track: ", sys.exc_info()[0])
         raise
-    finally:
-        r.close()
 
-    return None
 
 """
     Downloads single file and stores it locally. Function is designed to be used with parallel library.
+    When caching is enabled the file is stored in the cache and already cached files are only revalidated
+    with a conditional request. The returned file is always in outdir, cached files are linked into it.
+    The response is streamed in DOWNLOAD_CHUNK_SIZE chunks into a temporary file which is renamed when the
+    download is complete. Failed attempts are resumed with a range request if the server supports it.
 """
 def _download_file(pars):
-    result = None
     url = pars[0]
     outdir = pars[1]
+    cache = MEDIA_CACHE if len(pars) < 3 or pars[2] == True else None
+    max_age = pars[3] if len(pars) > 3 else None
     retries = 0
 
     if not os.path.exists(outdir):
-        os.makedirs(outdir)
-
-    while retries < 3:
-        time.sleep(retries)
-        retries += 1
-        r = None
         try:
-            r = urllib2.urlopen(url)
-            file = os.path.normpath(os.path.join(outdir, str(uuid.uuid4())))
-            with open(file,'wb+') as o:
-                while True:
-                    data = r.read()
-                    if not data: break
-                    o.write(data)
-            result = file
-            break
-        except:
-            print traceback.format_exc(sys.exc_info())
-            if retries == 3: raise
-        finally:
-            if r: r.close()
-            
+            os.makedirs(outdir)
+        except OSError:
+            if not os.path.isdir(outdir): raise
+
+    # use the cached copy without revalidation if it is fresh enough
+    fresh = cache.peek(url, max_age) if cache and max_age != None else None
+    fresh = cache.link(fresh[0], outdir) if fresh else None
+    if fresh:
+        cache.hit(url)
+        return fresh
+
+    # prepare validators of the cached copy if any
+    cached = cache.peek(url) if cache else None
+    headers = {}
+    if cached and cached[1].get("etag"): headers["If-None-Match"] = cached[1]["etag"]
+    if cached and cached[1].get("last_modified"): headers["If-Modified-Since"] = cached[1]["last_modified"]
+
+    file = os.path.normpath(os.path.join(outdir, str(uuid.uuid4())))
+    part = cache.mktemp() if cache else file + ".part"
+    received = 0
+    expected = None
+    meta = {}
+    try:
+        while True:
+            r = None
+            try:
+                request_headers = dict(headers)
+                if received > 0:
+                    request_headers["Range"] = "bytes=%d-" % received
+                    validator = meta["etag"] if meta["etag"] and not meta["etag"].startswith("W/") else meta["last_modified"]
+                    if validator: request_headers["If-Range"] = validator
+                r = HTTP_POOL.urlopen(url, request_headers)
+                info = r.info()
+                if received > 0 and r.getcode() != 206:
+                    # the server ignored the range request, so the download starts over
+                    received = 0
+                if received == 0:
+                    length = info.getheader('Content-Length')
+                    expected = int(length) if length and length.isdigit() else None
+                    meta = {"etag": info.getheader('ETag'), "last_modified": info.getheader('Last-Modified')}
+                    # the cached copy is stale, so the following attempts must not be conditional
+                    headers = {}
+                with open(part, 'ab' if received > 0 else 'wb') as o:
+                    while True:
+                        jobs.check_cancelled()
+                        data = r.read(DOWNLOAD_CHUNK_SIZE)
+                        if not data: break
+                        o.write(data)
+                        received += len(data)
+                if expected != None and received != expected:
+                    if received > expected: received = 0
+                    raise IOError("Downloaded %d bytes of %s, expected %d" % (received, url, expected))
+                break
+            except urllib2.HTTPError as e:
+                # cached copy is still valid
+                if e.code == 304 and bool(headers) == True:
+                    linked = cache.link(cached[0], outdir)
+                    if linked:
+                        cache.hit(url)
+                        return linked
+                    # the cached copy was evicted meanwhile, so it is downloaded again
+                    headers = {}
+                    continue
+                retries = _download_failed(retries)
+            except:
+                retries = _download_failed(retries)
+            finally:
+                if r: r.close()
+    except:
+        if os.path.exists(part): os.remove(part)
+        raise
+
+    if cache:
+        cache.miss()
+        return cache.put(url, part, meta, outdir)
+    os.rename(part, file)
+    return file
+
+
+"""
+    Private method that logs failed download attempt and waits before the next one. Raises the error when
+    all DOWNLOAD_RETRIES are used.
+"""
+def _download_failed(retries):
+    # cancelled downloads are not repeated
+    jobs.check_cancelled()
+    print traceback.format_exc(sys.exc_info())
+    retries += 1
+    if retries >= DOWNLOAD_RETRIES: raise
+    time.sleep(DOWNLOAD_BACKOFF_T * 2 ** (retries - 1))
+    return retries
+
+
+"""
+    Downloads files from url list. Files are fetched concurrently and returned in the order of the passed urls.
+    If skip_failed is set urls that could not be downloaded are left out, otherwise the first failure is raised.
+    Failures of the first required urls are raised even if skip_failed is set.
+"""
+def _download_file_list(list, outdir, concurrency = DOWNLOAD_CONCURRENCY, host_concurrency = DOWNLOAD_HOST_CONCURRENCY, skip_failed = False, cache = True, max_age = None, required = 0):
+    result = []
+    for i, (url, file, error) in enumerate(_download_all(list, outdir, concurrency, host_concurrency, cache, max_age)):
+        if error == None:
+            result.append(file)
+        elif skip_failed == True and i >= required:
+            print "Failed to download %s: %s" % (url, error)
+        else:
+            raise error
     return result
 
 
 """
-    Downloads files from url list.
+    Downloads all files from url list and returns (url, file, error) tuple for every url in the input order.
+"""
+def _download_all(list, outdir, concurrency = DOWNLOAD_CONCURRENCY, host_concurrency = DOWNLOAD_HOST_CONCURRENCY, cache = True, max_age = None):
+    results = _run_parallel(lambda u: _download_file((u, outdir, cache, max_age)), list, concurrency, host_concurrency, key = _get_host)
+    return [(u, r[0], r[1]) for u, r in zip(list, results)]
+
+
+"""
+    Private method that applies func to every item using a bounded pool of worker threads. The number of items
+    being processed at the same time that share the same key (e.g. host) is limited by key_concurrency.
+    Returns list of (result, error) tuples in the order of the passed items.
+"""
+def _run_parallel(func, items, concurrency, key_concurrency = None, key = None):
+    items = [i for i in items]
+    results = [None] * len(items)
+    if bool(items) == False:
+        return results
+
+    queue = Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    semaphores = {}
+    lock = threading.Lock()
+    job = jobs.current_job()
+
+    def get_semaphore(item):
+        if key == None or key_concurrency == None:
+            return None
+        k = key(item)
+        with lock:
+            if k not in semaphores:
+                semaphores[k] = threading.BoundedSemaphore(key_concurrency)
+            return semaphores[k]
+
+    def worker():
+        # the work is done on behalf of the job of the calling thread
+        jobs.set_current_job(job)
+        while True:
+            if job != None and job.cancelled():
+                return
+            try:
+                i, item = queue.get_nowait()
+            except:
+                return
+            semaphore = get_semaphore(item)
+            if semaphore: semaphore.acquire()
+            try:
+                results[i] = (func(item), None)
+            except Exception as e:
+                results[i] = (None, e)
+            finally:
+                if semaphore: semaphore.release()
+
+    threads = [threading.Thread(target = worker) for _ in range(0, max(1, min(concurrency, len(items))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+"""
+    Returns the host part of the passed url.
 """
-def _download_file_list(list, outdir):
-    #pool = multiprocessing.Pool(processes=4)
-    #return pool.map(_download_file, [(u, outdir) for u in list])
-    return [_download_file((u, outdir)) for u in list]
\ No newline at end of file
+def _get_host(url):
+    return urlparse.urlparse(url).netloc.lower()
@@ -1,4 +1,11 @@
+import os
+import re
+import time
+import tempfile
 import asapvideo
+import jobs
+from ffmpy import FFmpeg
+from filters import optimize_graph, optimizer
 
 def test_make_from_url_list():
     list = [
@@ -74,5 +81,266 @@ def test_concat_videos():
     concat_videos(list, audio=False, outdir = "c:\\temp")
     print "finished for %d seconds" % (time.time() - t)
 
+BENCHMARK_IMAGES = ["https://printastic-pdfpreview.imgix.net/796092bcda15-b7c91f455aea4ba698281cb3e0478e4a.pdf?page=%d" % i for i in range(1, 11)]
+BENCHMARK_DIR = os.path.join(tempfile.gettempdir(), "asapvideo-benchmark")
+
+def _benchmark_images():
+    return asapvideo._download_file_list(BENCHMARK_IMAGES, BENCHMARK_DIR)
+
+def test_make_many_inputs():
+    # the filter graph of hundreds of slides does not fit the command line and is passed in script file
+    images = _benchmark_images() * 30
+    t=time.time()
+    output = asapvideo._make(images, 1, BENCHMARK_DIR, "ffmpeg", 320, 240, False, "zoompan", "slidein", asapvideo.BatchMode.none, still_input = "decode_once", profile = "preview")
+    print "%d slides: finished for %d seconds, %d bytes" % (len(images), time.time() - t, os.path.getsize(output))
+
+def test_make_progress():
+    # progress events are reported while the video is encoded, the last one ends the run
+    events = []
+    output = asapvideo._make(_benchmark_images(), 1, BENCHMARK_DIR, "ffmpeg", 320, 240, False, "zoompan", None, asapvideo.BatchMode.none, profile = "preview", progress = events.append)
+    for e in events:
+        print "frame %(frame)s, %(out_time)s seconds, speed %(speed)sx" % e
+    print "%d progress events, last: %s" % (len(events), events[-1]["progress"] if events else None)
+
+def test_make_async():
+    # the renders run at the same time, the cancelled one kills its ffmpeg process and raises JobCancelled
+    t=time.time()
+    submitted = [asapvideo.make_from_url_list_async(BENCHMARK_IMAGES, 1, tempfile.mkdtemp(), "ffmpeg", 320, 240, False, "zoompan", profile = "preview") for _ in range(0, 4)]
+    submitted[-1].cancel()
+    for job in submitted:
+        try:
+            print "finished: %s" % job.result()
+        except jobs.JobCancelled as e:
+            print "cancelled: %s" % e
+    print "%d jobs: finished for %.2f seconds" % (len(submitted), time.time() - t)
+
+def test_render_scheduler_threads():
+    # render started alone gets all cores, the threads are capped to the shares only while other renders run
+    scheduler = jobs.RenderScheduler(8, 8)
+    with scheduler.slot(0.1) as threads:
+        assert threads == 8, threads
+        with scheduler.slot(0.5) as threads:
+            assert threads == 4, threads
+    with scheduler.slot(1.0) as threads:
+        assert threads == 8, threads
+    assert scheduler.stats()["threads"] == 0
+    # renders running in the slot of their parent (segments of parallel render) do not take another one
+    asapvideo.RENDER_SCHEDULER, scheduler = jobs.RenderScheduler(8, 8), asapvideo.RENDER_SCHEDULER
+    try:
+        with asapvideo._render_slot("zoompan", None, 1200, 800) as threads:
+            with asapvideo._render_slot("zoompan", None, 1200, 800, max(1, threads / 8)) as segment_threads:
+                assert segment_threads == 1
+                assert asapvideo.RENDER_SCHEDULER.stats()["running"] == 1
+    finally:
+        asapvideo.RENDER_SCHEDULER = scheduler
+
+def test_frame_input_errors():
+    # error of the frames piped to the encoder fails the render instead of leaving truncated video
+    def frames():
+        yield "\0" * 320 * 240 * 3
+        raise ValueError("corrupt image")
+    ff = FFmpeg(inputs = {"-": "-f rawvideo -pix_fmt rgb24 -s 320x240 -framerate 25"}, outputs = {os.path.join(BENCHMARK_DIR, "truncated.mp4"): "-y"})
+    try:
+        ff.run(input_data = frames())
+        print "truncated video was created"
+    except ValueError as e:
+        print "failed: %s" % e
+
+def benchmark_render_scheduler():
+    # the same jobs rendered with all cores per render and with the threads shared by the scheduler
+    for scheduler in [None, asapvideo.RENDER_SCHEDULER]:
+        asapvideo.RENDER_SCHEDULER = scheduler
+        t=time.time()
+        submitted = [asapvideo.make_from_url_list_async(BENCHMARK_IMAGES, 2, tempfile.mkdtemp(), "ffmpeg", None, None, False, effect, transition) for effect, transition in [("zoompan", "slidein"), ("zoompan", None), (None, "slidein"), (None, None)] * 4]
+        for job in submitted:
+            job.result()
+        print "%s: %d jobs finished for %.2f seconds" % ("scheduled" if scheduler else "all cores", len(submitted), time.time() - t)
+        if scheduler: print scheduler.stats()
+
+def benchmark_still_input_modes():
+    images = _benchmark_images()
+    # decoded frames of single slide
+    for mode, options, filters in [("loop", "-loop 1", "trim=duration=%d" % asapvideo.SCENE_DURATION_T), ("decode_once", None, "loop=loop=-1:size=1:start=0,trim=duration=%d" % asapvideo.SCENE_DURATION_T)]:
+        out = FFmpeg(global_options = ["-y", "-v", "verbose"], inputs = {images[0]: options}, outputs = {"-": "-vf \"%s\" -f null" % filters}).run()
+        print "%s: %s frames decoded per slide" % (mode, re.findall("(\\d+) frames decoded", out)[0])
+    # whole render
+    for mode in ["loop", "decode_once"]:
+        t=time.time()
+        asapvideo._make(images, asapvideo.SCENE_DURATION_T, BENCHMARK_DIR, "ffmpeg", None, None, False, "zoompan", None, asapvideo.BatchMode.none, still_input = mode)
+        print "%s: finished for %.2f seconds" % (mode, time.time() - t)
+
+def benchmark_audio_loop_modes():
+    track = (asapvideo._download_file_list(["https://s3.amazonaws.com/asapvideo/audio/track1.wav"], BENCHMARK_DIR)[0], 11)
+    for length in [60, 600, 1800]:
+        for mode in ["replicate", "stream_loop"]:
+            t=time.time()
+            asapvideo._audio_bed_ffmpeg(track, length, os.path.join(BENCHMARK_DIR, "bed.m4a"), "ffmpeg", mode).run()
+            print "%s %d seconds: finished for %.2f seconds" % (mode, length, time.time() - t)
+
+def benchmark_encoder_profiles():
+    images = _benchmark_images()
+    frames = len(images) * asapvideo.SCENE_DURATION_T * asapvideo.FPS
+    for profile in sorted(asapvideo.ENCODER_PROFILES.keys()):
+        t=time.time()
+        output = asapvideo._make(images, asapvideo.SCENE_DURATION_T, BENCHMARK_DIR, "ffmpeg", None, None, False, "zoompan", None, asapvideo.BatchMode.none, profile = profile)
+        t = time.time() - t
+        print "%s: %.1f fps, %d bytes" % (profile, frames / t, os.path.getsize(output))
+
+# Returns every filter applied on the way to label, split only copies the stream and is left out. Filters of chains
+# with more inputs follow the paths of the inputs.
+def _trace_graph(filters, label):
+    chains = [optimizer._parse_chain(f) for f in filters]
+    def trace(label):
+        chain = next((c for c in chains if label in c["outputs"]), None)
+        if chain == None:
+            return [label]
+        inputs = [trace(i) for i in chain["inputs"]]
+        path = inputs[0] if len(inputs) == 1 else [tuple([tuple(i) for i in inputs])]
+        return path + [f for f in chain["filters"] if f.split("=", 1)[0] not in ["split", "asplit"]]
+    return trace(label)
+
+def _check_optimized(filters, keep, expected, path):
+    optimized, stats = optimize_graph(filters, keep)
+    assert optimized == expected, optimized
+    assert _trace_graph(optimized, keep[-1]) == path, _trace_graph(optimized, keep[-1])
+    assert stats["after"]["chains"] == len(expected)
+    return stats
+
+def test_optimizer_drops_noops():
+    _check_optimized(["[0:v]null,scale=2:2[a]", "[a]null[b]", "[b]setsar=1[out]"], ["out"], ["[0:v]scale=2:2,setsar=1[out]"], ["0:v", "scale=2:2", "setsar=1"])
+    _check_optimized(["[0:v]scale=2:2[a]", "[a]null[out]"], ["out"], ["[0:v]scale=2:2[out]"], ["0:v", "scale=2:2"])
+    # kept labels survive even when their chains do nothing
+    _check_optimized(["[0:v]scale=2:2[a]", "[a]null[out]"], ["a", "out"], ["[0:v]scale=2:2[a]", "[a]null[out]"], ["0:v", "scale=2:2", "null"])
+
+def test_optimizer_dedupes_idempotent_filters():
+    _check_optimized(
+        ["[0:v]setsar=1,setsar=1[a]", "[a]scale=2:2[b]", "[b]scale=2:2,setpts=PTS-STARTPTS,setpts=PTS-STARTPTS[out]"], ["out"],
+        ["[0:v]setsar=1,scale=2:2,setpts=PTS-STARTPTS[out]"], ["0:v", "setsar=1", "scale=2:2", "setpts=PTS-STARTPTS"])
+    # fade is not idempotent, repeating it changes the video
+    _check_optimized(["[0:v]fade=t=in:d=1[a]", "[a]fade=t=in:d=1[out]"], ["out"], ["[0:v]fade=t=in:d=1,fade=t=in:d=1[out]"], ["0:v", "fade=t=in:d=1", "fade=t=in:d=1"])
+    # neither are timestamps scaling and relative scales, every repetition slows down or shrinks the video again
+    _check_optimized(["[0:v]setpts=2*PTS[a]", "[a]setpts=2*PTS[out]"], ["out"], ["[0:v]setpts=2*PTS,setpts=2*PTS[out]"], ["0:v", "setpts=2*PTS", "setpts=2*PTS"])
+    _check_optimized(["[0:v]scale=iw/2:ih/2[a]", "[a]scale=iw/2:ih/2[out]"], ["out"], ["[0:v]scale=iw/2:ih/2,scale=iw/2:ih/2[out]"], ["0:v", "scale=iw/2:ih/2", "scale=iw/2:ih/2"])
+
+def test_optimizer_hoists_above_splits():
+    _check_optimized(
+        ["[0:v]split=2[a][b]", "[a]scale=2:2,fade=t=in:d=1[c]", "[b]scale=2:2,fade=t=out:d=1[d]", "[c][d]concat=n=2[out]"], ["out"],
+        ["[0:v]scale=2:2,split=2[a][b]", "[a]fade=t=in:d=1[c]", "[b]fade=t=out:d=1[d]", "[c][d]concat=n=2[out]"],
+        [(("0:v", "scale=2:2", "fade=t=in:d=1"), ("0:v", "scale=2:2", "fade=t=out:d=1")), "concat=n=2"])
+    # different filters stay below the split
+    filters = ["[0:v]split=2[a][b]", "[a]hflip[c]", "[b]vflip[d]", "[c][d]concat=n=2[out]"]
+    _check_optimized(filters, ["out"], filters, [(("0:v", "hflip"), ("0:v", "vflip")), "concat=n=2"])
+
+def test_optimizer_pipelines():
+    # the generated graphs repeat only these filters, the optimized graph applies the same filters without the repetitions
+    repeated = ["setsar=1:1", "setpts=PTS-STARTPTS", "scale=120:80"]
+    def expected(path):
+        result = []
+        for f in path:
+            f = tuple([tuple(expected(i)) for i in f]) if isinstance(f, tuple) else f
+            if f == "null" or (result and result[-1] == f and f in repeated):
+                continue
+            result.append(f)
+        return result
+    for effect, transition in [("zoompan", None), (None, "fadeinout"), (None, "slidein"), ("zoompan", "slidein")]:
+        pipeline = asapvideo._get_pipeline(effect, transition, 5, 120, 80, asapvideo.FPS, True, False, "decode_once")[0]
+        filters = pipeline.generate(["%d:v" % i for i in range(0, 4)])[0]
+        optimized = optimize_graph(filters, ["video"])[0]
+        assert _trace_graph(optimized, "video") == expected(_trace_graph(filters, "video")), (effect, transition)
+
+def test_graph_stats():
+    before = asapvideo.get_graph_stats()
+    asapvideo._optimize_graph(["[0:v]null,scale=2:2[a]", "[a]null[b]", "[b]setsar=1[video]"], ["video"])
+    after = asapvideo.get_graph_stats()
+    assert after["graphs"] == before["graphs"] + 1
+    assert after["before"]["chains"] == before["before"].get("chains", 0) + 3
+    assert after["after"]["chains"] == before["after"].get("chains", 0) + 1
+
+# Returns the duration in seconds of the labeled stream of the filter graph, inputs are endless still images.
+def _graph_duration(filters, label):
+    chains = [optimizer._parse_chain(f) for f in filters]
+    def duration(label):
+        chain = next((c for c in chains if label in c["outputs"]), None)
+        if chain == None:
+            return float("inf")
+        durations = [duration(i) for i in chain["inputs"]]
+        d = durations[0]
+        for f in chain["filters"]:
+            name = optimizer._filter_name(f)
+            if name == "concat":
+                d = sum(durations)
+            elif name == "overlay" and "shortest=1" in f:
+                d = min(durations)
+            elif name == "trim":
+                d = min(d, float(re.search(r"duration=([0-9.]+)", f).group(1)))
+        return d
+    return duration(label)
+
+def test_segment_durations():
+    # segments rendered in parallel add up to the single render, only the last one ends the last slide
+    images = ["%d:v" % i for i in range(0, 9)]
+    for effect, transition in [(None, None), ("zoompan", None), (None, "fadeinout"), (None, "slidein"), ("zoompan", "slidein")]:
+        single = asapvideo._get_pipeline(effect, transition, 5, 120, 80, 25, True, True, "decode_once")[0]
+        total = _graph_duration(single.generate(images)[0], "video")
+        assert total == asapvideo._get_video_t(len(images), 5, effect, transition), (effect, transition, total)
+        segments = 0
+        for b, e in [(0, 3), (3, 6), (6, 9)]:
+            last = e == len(images)
+            pipeline = asapvideo._get_pipeline(effect, transition, 5, 120, 80, 25, b == 0, True, "decode_once", last)
+            preserve_first = pipeline[1]
+            streams = images[max(b-1, 0):e] if b == 0 or preserve_first else images[b:e]
+            duration = _graph_duration(pipeline[0].generate(streams)[0], "video")
+            assert duration == asapvideo._get_video_t(e - b, 5, effect, transition, last), (effect, transition, b, duration)
+            segments += duration
+        assert segments == total, (effect, transition, segments, total)
+
+def benchmark_filter_graph_optimizer():
+    images = _benchmark_images()
+    for effect, transition in [("zoompan", None), (None, "slidein"), ("zoompan", "slidein")]:
+        for optimize in [False, True]:
+            asapvideo.OPTIMIZE_FILTER_GRAPH = optimize
+            t=time.time()
+            asapvideo._make(images, asapvideo.SCENE_DURATION_T, BENCHMARK_DIR, "ffmpeg", None, None, False, effect, transition, asapvideo.BatchMode.none, still_input = "decode_once")
+            print "%s%s optimized=%s: finished for %.2f seconds" % (effect or "", transition or "", optimize, time.time() - t)
+    asapvideo.OPTIMIZE_FILTER_GRAPH = True
+
+def benchmark_zoompan_oversample():
+    # large photos, zoompan crops and scales the full image for every frame unless it is oversampled, normalized
+    # images are scaled to the oversampled size once
+    images = asapvideo._download_file_list([i + "&w=4000" for i in BENCHMARK_IMAGES], BENCHMARK_DIR)
+    frames = len(images) * asapvideo.SCENE_DURATION_T * asapvideo.FPS
+    for normalize in [False, True]:
+        for oversample in [None, 3, 2, 1.5, 1]:
+            asapvideo.ZOOMPAN_OVERSAMPLE = oversample
+            t=time.time()
+            asapvideo._make(images, asapvideo.SCENE_DURATION_T, BENCHMARK_DIR, "ffmpeg", None, None, False, "zoompan", None, asapvideo.BatchMode.none, normalize = normalize, profile = "preview")
+            print "oversample %s normalized=%s: %.1f fps" % (oversample, normalize, frames / (time.time() - t))
+    asapvideo.ZOOMPAN_OVERSAMPLE = None
+
+def benchmark_frame_generator():
+    images = _benchmark_images()
+    frames = len(images) * asapvideo.SCENE_DURATION_T * asapvideo.FPS
+    for animation in [("zoompan", None), (None, "slidein"), ("zoompan", "slidein")]:
+        for backend, interpolation in [("filters", None), ("frames", "bilinear"), ("frames", "nearest")]:
+            asapvideo.FRAME_GENERATOR_ANIMATIONS = [(animation[0] or "") + (animation[1] or "")] if backend == "frames" else []
+            asapvideo.FRAME_INTERPOLATION = interpolation
+            t=time.time()
+            asapvideo._make(images, asapvideo.SCENE_DURATION_T, BENCHMARK_DIR, "ffmpeg", None, None, False, animation[0], animation[1], asapvideo.BatchMode.none, profile = "preview")
+            print "%s%s %s %s: %.1f fps" % (animation[0] or "", animation[1] or "", backend, interpolation or "", frames / (time.time() - t))
+    asapvideo.FRAME_GENERATOR_ANIMATIONS = []
+    asapvideo.FRAME_INTERPOLATION = "bilinear"
+
+def benchmark_graph_generation():
+    for effect, transition in [("zoompan", None), (None, "slidein"), ("zoompan", "slidein")]:
+        t=time.time()
+        pipeline = asapvideo._get_pipeline(effect, transition, asapvideo.SCENE_DURATION_T, asapvideo.OUTPUT_VIDEO_WIDTH, asapvideo.OUTPUT_VIDEO_HEIGHT, asapvideo.FPS, True, False, "decode_once")[0]
+        print "%s%s: pipeline built for %.4f seconds" % (effect or "", transition or "", time.time() - t)
+        for count in [10, 1000, 10000]:
+            t=time.time()
+            filters = pipeline.generate(["%d:v" % i for i in range(0, count)])[0]
+            generated_t = time.time() - t
+            stats = optimize_graph(filters, ["video"])[1]
+            print "%s%s %d slides: generated for %.4f seconds, optimized for %.4f seconds, %d filters" % (effect or "", transition or "", count, generated_t, time.time() - t - generated_t, stats["after"]["nodes"])
+
 #if __name__ == "__main__":
 #    test_make_from_url_list()
\ No newline at end of file
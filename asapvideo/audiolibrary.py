@@ -0,0 +1,60 @@
+import os
+import json
+import time
+import random
+import urllib2
+import threading
+
+"""
+    Audio tracks library. The tracks index is loaded once per process either from a local file or from url. Local
+    index is reloaded when the file changes, remote one is revalidated with a conditional request after ttl
+    seconds, so warm processes do not download it again.
+"""
+class AudioLibrary(object):
+    def __init__(self, index, pool, ttl):
+        self._index = index
+        self._pool = pool
+        self._ttl = ttl
+        self._tracks = None
+        self._etag = None
+        self._version = None
+        self._loaded = 0
+        self._lock = threading.Lock()
+
+    # Returns all tracks from the index as list of dictionaries with url, length and type keys.
+    def get_tracks(self):
+        with self._lock:
+            if self._is_remote():
+                if self._tracks == None or time.time() - self._loaded > self._ttl:
+                    self._load_remote()
+            elif self._tracks == None or os.path.getmtime(self._index) != self._version:
+                self._load_local()
+            return self._tracks
+
+    # Returns random (url, length) tuple of a track suitable for video with the passed length.
+    def select(self, length):
+        tracks = [(t["url"], t["length"]) for t in self.get_tracks() if (t["type"] == "track" and t["length"] <= length) or t["type"] == "loop"]
+        random.shuffle(tracks)
+        return next(iter(tracks))
+
+    def _is_remote(self):
+        return self._index.startswith("http://") or self._index.startswith("https://")
+
+    def _load_local(self):
+        self._version = os.path.getmtime(self._index)
+        with open(self._index) as f:
+            self._tracks = json.load(f)["tracks"]
+        self._loaded = time.time()
+
+    def _load_remote(self):
+        r = None
+        try:
+            r = self._pool.urlopen(self._index, {"If-None-Match": self._etag} if self._etag and self._tracks != None else {})
+            self._tracks = json.loads(r.read())["tracks"]
+            self._etag = r.info().getheader("ETag")
+        except urllib2.HTTPError as e:
+            # the index has not changed since the last load
+            if e.code != 304: raise
+        finally:
+            if r: r.close()
+        self._loaded = time.time()
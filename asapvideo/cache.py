@@ -0,0 +1,236 @@
+import os
+import json
+import errno
+import uuid
+import time
+import shutil
+import hashlib
+import threading
+
+CHUNK_SIZE = 64 * 1024
+ORPHAN_BLOB_AGE = 60
+
+"""
+    Persistent on-disk file cache. Entries are looked up by arbitrary string keys and point to content addressed
+    blobs, so equal files stored under different keys take the disk space only once. The least recently used
+    entries are evicted when the total size of the blobs exceeds max_size or when less than min_free bytes are left
+    free on the cache file system, so the cache does not take the space needed by the outputs. All writes are atomic renames, so the
+    cache directory can be shared by several processes. Files being used must be taken with the dir argument: they
+    are hard linked into it, so the eviction by another thread or process does not remove them.
+"""
+class MediaCache(object):
+    def __init__(self, root, max_size, min_free = 0):
+        self._root = root
+        self._max_size = max_size
+        self._min_free = min_free
+        self._entries = os.path.join(root, "entries")
+        self._blobs = os.path.join(root, "blobs")
+        self._tmp = os.path.join(root, "tmp")
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+        for d in [self._entries, self._blobs, self._tmp]:
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    # another process could have created it meanwhile
+                    if not os.path.isdir(d): raise
+
+    # Returns (path, meta) tuple for the key or None if there is no such entry. If max_age is passed
+    # entries stored more than max_age seconds ago are treated as missing. If dir is passed the returned path
+    # is a link in dir (see link).
+    def get(self, key, max_age = None, dir = None):
+        entry = self._read_entry(key)
+        path = os.path.join(self._blobs, entry["blob"]) if entry else None
+        if entry == None or not os.path.isfile(path) or (max_age != None and time.time() - entry["stored"] > max_age):
+            self._count("misses")
+            return None
+        if dir != None:
+            path = self.link(path, dir)
+            if path == None:
+                self._count("misses")
+                return None
+        self._touch(key)
+        self._count("hits")
+        return path, entry["meta"]
+
+    # Returns (path, meta) tuple for the key without touching it or updating the counters. Entries older than
+    # max_age seconds are ignored if it is passed.
+    def peek(self, key, max_age = None):
+        entry = self._read_entry(key)
+        path = os.path.join(self._blobs, entry["blob"]) if entry else None
+        if entry == None or not os.path.isfile(path) or (max_age != None and time.time() - entry["stored"] > max_age):
+            return None
+        return path, entry["meta"]
+
+    # Marks an entry returned by peek as used, e.g. after it was successfully revalidated.
+    def hit(self, key):
+        self._touch(key)
+        self._count("hits")
+
+    def miss(self):
+        self._count("misses")
+
+    # Adds the value to a custom counter reported by stats, e.g. time saved by the cache hits.
+    def add(self, counter, value):
+        self._count(counter, value)
+
+    # Moves the file into the cache under the key and returns the path of the cached file, a link in dir if it
+    # is passed (see link).
+    def put(self, key, file, meta = None, dir = None):
+        digest = file_digest(file)
+        path = os.path.join(self._blobs, digest)
+        if os.path.isfile(path):
+            os.remove(file)
+        else:
+            tmp = self.mktemp()
+            shutil.move(file, tmp)
+            os.rename(tmp, path)
+        self._write_entry(key, {"key": key, "blob": digest, "size": os.path.getsize(path), "meta": meta or {}, "stored": time.time()})
+        self._count("stores")
+        # the link is made before the eviction, which could remove the new blob if the cache is too small
+        if dir != None:
+            path = self.link(path, dir)
+        self.evict()
+        return path
+
+    # Hard links the cached file into dir and returns the path of the link, it stays valid when the entry is evicted.
+    # The file is copied if it could not be linked (e.g. dir is on another file system). Returns None if the file
+    # was evicted meanwhile.
+    def link(self, path, dir):
+        target = os.path.join(dir, str(uuid.uuid4()))
+        try:
+            try:
+                os.link(path, target)
+            except (AttributeError, OSError):
+                shutil.copyfile(path, target)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT and not os.path.isfile(path):
+                return None
+            raise
+        return target
+
+    # Returns path of a new temporary file on the cache file system that could be atomically renamed into it.
+    def mktemp(self):
+        return os.path.join(self._tmp, str(uuid.uuid4()))
+
+    # Removes the least recently used entries until the total size of the cache fits max_size and the free space.
+    def evict(self):
+        with self._lock:
+            sizes = {}
+            for name in os.listdir(self._blobs):
+                try:
+                    sizes[name] = os.path.getsize(os.path.join(self._blobs, name))
+                except OSError:
+                    pass
+            total = sum(sizes.values())
+            max_size = self._max_size
+            if self._min_free:
+                max_size = min(max_size, total + _free_space(self._root) - self._min_free)
+            # the entries are read only if something has to be evicted
+            if total <= max_size:
+                return
+            entries = []
+            for name in os.listdir(self._entries):
+                file = os.path.join(self._entries, name)
+                try:
+                    with open(file) as f:
+                        entries.append((os.path.getmtime(file), file, json.load(f)["blob"]))
+                except (IOError, OSError, ValueError):
+                    pass
+            refs = {}
+            for e in entries:
+                refs[e[2]] = refs.get(e[2], 0) + 1
+            # blobs that are not referenced by any entry anymore go first, unless they were just stored
+            for blob, size in sizes.items():
+                file = os.path.join(self._blobs, blob)
+                if blob not in refs and _mtime(file) < time.time() - ORPHAN_BLOB_AGE:
+                    _remove(file)
+                    total -= size
+            for mtime, file, blob in sorted(entries):
+                if total <= max_size: break
+                _remove(file)
+                self._stats["evictions"] += 1
+                refs[blob] -= 1
+                if refs[blob] == 0 and blob in sizes:
+                    _remove(os.path.join(self._blobs, blob))
+                    total -= sizes[blob]
+
+    # Returns dictionary with the hit, miss, store, eviction and custom counters and the hit ratio.
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / float(lookups) if lookups else 0.0
+        return stats
+
+    def _count(self, counter, value = 1):
+        with self._lock:
+            self._stats[counter] = self._stats.get(counter, 0) + value
+
+    def _entry_file(self, key):
+        return os.path.join(self._entries, hashlib.sha1(key.encode("utf-8") if isinstance(key, unicode) else key).hexdigest())
+
+    def _read_entry(self, key):
+        try:
+            with open(self._entry_file(key)) as f:
+                entry = json.load(f)
+            return entry if entry["key"] == key else None
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write_entry(self, key, entry):
+        tmp = self.mktemp()
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        os.rename(tmp, self._entry_file(key))
+
+    def _touch(self, key):
+        try:
+            os.utime(self._entry_file(key), None)
+        except OSError:
+            pass
+
+
+"""
+    Returns sha1 hex digest of the file content.
+"""
+def file_digest(file):
+    h = hashlib.sha1()
+    with open(file, "rb") as f:
+        while True:
+            data = f.read(CHUNK_SIZE)
+            if not data: break
+            h.update(data)
+    return h.hexdigest()
+
+
+"""
+    Returns modification time of the file or 0 if it was removed meanwhile.
+"""
+def _mtime(file):
+    try:
+        return os.path.getmtime(file)
+    except OSError:
+        return 0
+
+
+"""
+    Returns free space in bytes of the file system of the path, unlimited where it could not be found out.
+"""
+def _free_space(path):
+    try:
+        stat = os.statvfs(path)
+    except (AttributeError, OSError):
+        return float("inf")
+    return stat.f_bavail * stat.f_frsize
+
+
+"""
+    Removes file ignoring the errors caused by concurrent removal.
+"""
+def _remove(file):
+    try:
+        os.remove(file)
+    except OSError:
+        pass
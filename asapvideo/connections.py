@@ -0,0 +1,124 @@
+import socket
+import httplib
+import urllib2
+import urlparse
+import threading
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 5
+DRAIN_LIMIT = 64 * 1024
+
+"""
+    Pool of persistent HTTP/HTTPS connections. Idle connections are kept per host and reused by the next request
+    to the same host, so requests to a single CDN share the TCP and TLS handshakes. The pool is thread safe.
+"""
+class ConnectionPool(object):
+    def __init__(self, size, timeout):
+        self._size = size
+        self._timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._stats = {"new": 0, "reused": 0, "discarded": 0}
+
+    # Opens the url and returns response object that mimics the one returned by urllib2.urlopen. Redirects are
+    # followed and error statuses (including 304 Not Modified) are raised as urllib2.HTTPError as urllib2 does.
+    def urlopen(self, url, headers = None, method = "GET"):
+        for _ in range(0, MAX_REDIRECTS + 1):
+            response = self._request(method, url, headers or {})
+            status = response.getcode()
+            if status in REDIRECT_CODES and response.info().getheader("Location"):
+                response.close()
+                url = urlparse.urljoin(url, response.info().getheader("Location"))
+                if status == 303: method = "GET"
+                continue
+            if status >= 300:
+                response.close()
+                raise urllib2.HTTPError(url, status, response.reason, response.info(), None)
+            return response
+        raise urllib2.HTTPError(url, status, "Too many redirects", response.info(), None)
+
+    # Returns dictionary with the number of new, reused and discarded connections.
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    # Closes all idle connections.
+    def clear(self):
+        with self._lock:
+            idle = [c for connections in self._idle.values() for c in connections]
+            self._idle = {}
+        for c in idle:
+            c.close()
+
+    def _request(self, method, url, headers):
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme.lower(), parts.netloc.lower())
+        path = parts.path or "/"
+        if parts.query: path += "?" + parts.query
+        while True:
+            conn, reused = self._acquire(key)
+            try:
+                conn.request(method, path, headers = headers)
+                return PooledResponse(self, key, conn, conn.getresponse(), url)
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                # the server could have closed idle connection, so the request is repeated on a new one
+                if not reused: raise
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                self._stats["reused"] += 1
+                return idle.pop(), True
+            self._stats["new"] += 1
+        if key[0] == "https":
+            return httplib.HTTPSConnection(key[1], timeout = self._timeout), False
+        return httplib.HTTPConnection(key[1], timeout = self._timeout), False
+
+    def _release(self, key, conn, response):
+        # small unread bodies are drained so the connection could be reused
+        if not response.isclosed() and response.length != None and response.length <= DRAIN_LIMIT:
+            try:
+                response.read()
+            except (httplib.HTTPException, socket.error):
+                pass
+        if response.isclosed() and not response.will_close:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self._size:
+                    idle.append(conn)
+                    return
+        with self._lock:
+            self._stats["discarded"] += 1
+        conn.close()
+
+
+"""
+    Response returned by the connection pool. It returns its connection to the pool when closed.
+"""
+class PooledResponse(object):
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self._url = url
+        self.reason = response.reason
+
+    def getcode(self):
+        return self._response.status
+
+    def geturl(self):
+        return self._url
+
+    def info(self):
+        return self._response.msg
+
+    def read(self, amt = None):
+        return self._response.read(amt)
+
+    def close(self):
+        if self._conn:
+            self._pool._release(self._key, self._conn, self._response)
+            self._conn = None
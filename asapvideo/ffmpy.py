@@ -1,17 +1,30 @@
+import os
+import re
+import sys
 import errno
 import shlex
+import threading
+import collections
 import subprocess
 
 
 __version__ = '0.1.0'
 
+STDERR_TAIL_LINES = 100
+PROGRESS_LINE = re.compile(r'^(\w+)=(.*)$')
+LINE_SEPARATORS = re.compile(r'[\r\n]+')
+# callables invoked with every started process (e.g. to kill it on cancellation); a listener raising an
+# exception stops the run
+PROCESS_LISTENERS = []
+
 
 class FFmpeg(object):
     """Wrapper for various `ffmpeg <https://www.ffmpeg.org/>`_ related applications (ffmpeg,
     ffprobe).
     """
 
-    def __init__(self, executable='ffmpeg', global_options='', inputs=None, outputs=None):
+    def __init__(self, executable='ffmpeg', global_options='', inputs=None, outputs=None,
+                 filter_complex=None, filter_script=None):
         """Initialize wrapper object.
 
         Compiles FFmpegg command line from passed arguments (executable path, options, inputs and
@@ -25,15 +38,32 @@ class FFmpeg(object):
             ``-y``, ``-v`` etc.); can be specified either as a list/tuple of strings, or a
             space-separated string
         :param dict inputs: a dictionary specifying one or more inputs as keys with their
-            corresponding options as values
+            corresponding options as values; a list of (input, options) pairs can be used instead
+            when the same input has to be passed more than once
         :param dict outputs: a dictionary specifying one or more outputs as keys with their
             corresponding options as values
+        :param filter_complex: filter graph passed with ``-filter_complex``; can be specified either
+            as a string or a list of filter chains
+        :param str filter_script: path of a file the filter graph is written to when the command
+            runs; the graph is then passed with ``-filter_complex_script``, so its size is not
+            limited by the command line length, and the file is removed afterwards
         """
         self.executable = executable
         self._cmd = [executable]
         if not _is_sequence(global_options):
             global_options = shlex.split(global_options)
         self._cmd += global_options
+        self._filter_script = None
+        if filter_complex and filter_script:
+            # the script holds one filter chain per line
+            if _is_sequence(filter_complex):
+                filter_complex = ';\n'.join(filter_complex)
+            self._filter_script = (filter_script, filter_complex)
+            self._cmd += ['-filter_complex_script', filter_script]
+        elif filter_complex:
+            if _is_sequence(filter_complex):
+                filter_complex = ';'.join(filter_complex)
+            self._cmd += ['-filter_complex', filter_complex]
         self._cmd += self._merge_args_opts(inputs, add_input_option=True)
         self._cmd += self._merge_args_opts(outputs)
         self.cmd = subprocess.list2cmdline(self._cmd)
@@ -47,7 +77,8 @@ class FFmpeg(object):
         Iterates over the dictionary holding arguments (keys) and options (values). Merges each
         options string with its corresponding argument.
 
-        :param dict args_opts_dict: a dictionary of arguments and options
+        :param dict args_opts_dict: a dictionary of arguments and options or a list of
+            (argument, options) pairs
         :param dict kwargs: *input_option* - if specified prepends ``-i`` to input argument
         :return: merged list of strings with arguments and their corresponding options
         :rtype: list
@@ -57,7 +88,8 @@ class FFmpeg(object):
         if not args_opts_dict:
             return merged
 
-        for arg, opt in args_opts_dict.items():
+        items = args_opts_dict.items() if hasattr(args_opts_dict, 'items') else args_opts_dict
+        for arg, opt in items:
             if not _is_sequence(opt):
                 opt = shlex.split(opt or '')
             merged += opt
@@ -71,7 +103,7 @@ class FFmpeg(object):
 
         return merged
 
-    def run(self, input_data=None, verbose=False):
+    def run(self, input_data=None, verbose=False, progress=None):
         """Run ffmpeg command and get its output.
 
         If ``pipe`` protocol is used for input, `input_data` should contain data to be passed as
@@ -79,43 +111,69 @@ class FFmpeg(object):
         ``STDOUT`` and returned. More infor about ``pipe`` protocol `here
         <https://ffmpeg.org/ffmpeg-protocols.html#pipe>`_.
 
-        :param str input_data: media (audio, video, transport stream) data as a byte string (e.g. the
-            result of reading a file in binary mode)
+        ``STDERR`` is read line by line while the command runs and only its last
+        ``STDERR_TAIL_LINES`` lines are kept, so the memory does not grow with the length of the
+        run. If `progress` is passed, ffmpeg reports its progress in machine readable form
+        (``-progress``) and the callback is invoked with every report.
+
+        :param input_data: media (audio, video, transport stream) data as a byte string (e.g. the
+            result of reading a file in binary mode) or an iterable of byte strings (e.g. raw video
+            frames) that are written to ``STDIN`` as they are produced
         :param bool verbose: show ffmpeg output
-        :return: output of ffmpeg command as a byte string
+        :param progress: callable invoked with a dictionary of the progress values: ``frame``,
+            ``fps``, ``out_time`` (seconds), ``speed``, ``bitrate`` (kbit/s), ``total_size`` (bytes)
+            and ``progress`` (``continue`` or ``end`` for the last report); values ffmpeg does not
+            know yet are None
+        :return: output of ffmpeg command as a byte string, the tail of ``STDERR`` if nothing was
+            written to ``STDOUT``
         :rtype: str
         :raise: :class:`~.utils.ff.exceptions.FFRuntimeError` in case ffmpeg command fails
         """
-        if verbose:
-            stdout = stderr = None
-        else:
-            stdout = stderr = subprocess.PIPE
-
+        cmd = self._cmd
+        if progress:
+            # the progress is reported along with the log, the periodic stats line is not needed then
+            cmd = cmd[:1] + ['-progress', 'pipe:2', '-nostats'] + cmd[1:]
+        stdout = None if verbose else subprocess.PIPE
+        stderr = None if verbose and not progress else subprocess.PIPE
+
+        if self._filter_script:
+            with open(self._filter_script[0], 'w') as f:
+                f.write(self._filter_script[1])
         try:
-            ff_command = subprocess.Popen(
-                self._cmd,
-                stdin=subprocess.PIPE,
-                stdout=stdout,
-                stderr=stderr
-            )
-        except OSError as e:
-            if e.errno == errno.ENOENT:
-                raise FFExecutableNotFoundError("Executable '{0}' not found".format(self.executable))
-
-        out = ff_command.communicate(input=input_data)
+            try:
+                ff_command = subprocess.Popen(
+                    cmd,
+                    stdin=subprocess.PIPE,
+                    stdout=stdout,
+                    stderr=stderr
+                )
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    raise FFExecutableNotFoundError("Executable '{0}' not found".format(self.executable))
+                raise
+
+            try:
+                for listener in PROCESS_LISTENERS:
+                    listener(ff_command)
+            except Exception:
+                if ff_command.poll() is None:
+                    ff_command.kill()
+                ff_command.wait()
+                raise
+            out, tail = _communicate(ff_command, input_data, progress, verbose)
+        finally:
+            if self._filter_script and os.path.exists(self._filter_script[0]):
+                os.remove(self._filter_script[0])
         if ff_command.returncode != 0:
             raise FFRuntimeError(
                 "'{cmd}' exited with status {exit_code}\n\n{out}".format(
                     cmd=self.cmd,
                     exit_code=ff_command.returncode,
-                    out=out[1]
+                    out='\n'.join(tail)
                 )
             )
 
-        if out[0] or out[1]:
-            return out[0] or out[1]
-        else:
-            return None
+        return out or '\n'.join(tail) or None
 
 
 class FFprobe(FFmpeg):
@@ -150,6 +208,129 @@ class FFRuntimeError(Exception):
     """Raise when FFmpeg/FFprobe run fails."""
 
 
+def _communicate(process, input_data, progress, verbose):
+    """Write the input to the process and read its output until it exits.
+
+    ``STDIN`` is written and ``STDOUT`` is read in background threads, ``STDERR`` is read line by
+    line, progress reports are passed to the callback and the other lines are kept in bounded tail.
+    If producing the input fails, the process is killed and the error is raised once it exits, so a
+    truncated output is never taken for a complete one.
+
+    :param process: the running process
+    :param input_data: byte string, iterable of byte strings or None
+    :param progress: progress callback or None
+    :param bool verbose: echo the log lines to ``STDERR``
+    :return: tuple of the ``STDOUT`` data and the tail of ``STDERR`` lines
+    :rtype: tuple
+    """
+    out = []
+    errors = []
+    threads = [_start_thread(_write_input, process, input_data, errors)]
+    if process.stdout:
+        threads.append(_start_thread(lambda: out.append(process.stdout.read())))
+
+    tail = collections.deque(maxlen=STDERR_TAIL_LINES)
+    if process.stderr:
+        values = {}
+        for line in _read_lines(process.stderr):
+            match = PROGRESS_LINE.match(line) if progress else None
+            if match:
+                values[match.group(1)] = match.group(2).strip()
+                # every report ends with the progress key
+                if match.group(1) == 'progress':
+                    progress(_progress_event(values))
+                    values = {}
+                continue
+            tail.append(line)
+            if verbose:
+                sys.stderr.write(line + '\n')
+
+    process.wait()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return out[0] if out else None, tail
+
+
+def _start_thread(target, *args):
+    thread = threading.Thread(target=target, args=args)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _write_input(process, input_data, errors):
+    """Write byte string or iterable of byte strings to ``STDIN`` of the process and close it.
+
+    Errors of the iterable (and of the writing) are appended to `errors` and the process is killed
+    before ``STDIN`` is closed, so it does not finish the output from the partial input.
+    """
+    try:
+        if input_data is not None:
+            for chunk in ([input_data] if isinstance(input_data, str) else input_data):
+                process.stdin.write(chunk)
+    except IOError as e:
+        # the process exited before reading all the input, its exit status tells why
+        if e.errno not in (errno.EPIPE, errno.EINVAL):
+            errors.append(e)
+            _kill(process)
+    except BaseException as e:
+        errors.append(e)
+        _kill(process)
+    finally:
+        try:
+            process.stdin.close()
+        except IOError:
+            pass
+
+
+def _kill(process):
+    try:
+        if process.poll() is None:
+            process.kill()
+    except OSError:
+        pass
+
+
+def _read_lines(pipe):
+    """Yield lines of the pipe as they are written; ffmpeg ends its stats lines with ``\\r``."""
+    buffer = ''
+    while True:
+        data = os.read(pipe.fileno(), 4096)
+        if not data:
+            break
+        lines = LINE_SEPARATORS.split(buffer + data)
+        buffer = lines.pop()
+        for line in lines:
+            if line:
+                yield line
+    if buffer:
+        yield buffer
+
+
+def _progress_event(values):
+    """Convert the values of ffmpeg progress report to the progress event dictionary."""
+    # out_time_ms is reported in microseconds as well
+    out_time = _number(values.get('out_time_us', values.get('out_time_ms')))
+    return {
+        'frame': _number(values.get('frame'), int),
+        'fps': _number(values.get('fps')),
+        'out_time': out_time / 1000000.0 if out_time is not None else None,
+        'speed': _number(values.get('speed', '').rstrip('x')),
+        'bitrate': _number(values.get('bitrate', '').replace('kbits/s', '')),
+        'total_size': _number(values.get('total_size'), int),
+        'progress': values.get('progress')
+    }
+
+
+def _number(value, type=float):
+    try:
+        return type(value)
+    except (TypeError, ValueError):
+        return None
+
+
 def _is_sequence(obj):
     """Check if the object is a sequence (list, tuple etc.).
 
@@ -1,7 +1,8 @@
-__all__ = ['transitions', 'effects', 'core', 'audio']
+__all__ = ['transitions', 'effects', 'core', 'audio', 'optimizer']
 
 from core import *
 from transitions import *
 from effects import *
 from audio import *
+from optimizer import *
 
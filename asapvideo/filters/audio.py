@@ -8,7 +8,7 @@ class ReplicateAudioFilter(Filter):
         super(self.__class__, self).__init__(outstreamprefix)
         self._repetitions = repetitions
 
-    def generate(self, streams):
+    def generate(self, streams, offset = 0):
         output = []
         newstreams = []
         i = 0
@@ -21,6 +21,23 @@ class ReplicateAudioFilter(Filter):
                 i += 1
         return output, newstreams
 
+"""
+    Looped audio filter. The track is looped endlessly by the demuxer (the filter input options have to be passed
+    to the audio input) and the result is cut at the desired length, so the cost does not depend on the number
+    of repetitions.
+"""
+class LoopedAudioFilter(Filter):
+    input_options = "-stream_loop -1"
+
+    def __init__(self, length, outstreamprefix="laf"):
+        super(self.__class__, self).__init__(outstreamprefix)
+        self._expressions_accessor = FilterExpressionAccessor([
+            "atrim=end={l},asetpts=PTS-STARTPTS".format(l = length)
+        ])
+
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self._expressions_accessor, offset = offset)
+
 """
     Trim audio filter
 """
@@ -31,8 +48,8 @@ class TrimAudioFilter(Filter):
             "aselect=between(t\,0\,%d)" % length
         ])
 
-    def generate(self, streams):
-        return self._generate_base(streams, self._expressions_accessor)
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self._expressions_accessor, offset = offset)
 
 """
     Fade out audio filter
@@ -44,5 +61,5 @@ class FadeOutAudioFilter(Filter):
             "volume='if(lt(t,%d),1,max(1-(t-%d)/%d,0))':eval=frame" % (start,start,length)
         ])
 
-    def generate(self, streams):
-        return self._generate_base(streams, self._expressions_accessor)
\ No newline at end of file
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self._expressions_accessor, offset = offset)
\ No newline at end of file
@@ -1,39 +1,60 @@
-from random import random
+import random
+from fractions import gcd
+
+SPLIT_NAMES = "abcdefghijklmnopqrstuvxyz"
 
 """
-    Filter expressions accessor
+    Filter expressions accessor. The expressions are kept as tuple, so the accessor could be shared by filters used
+    for any number of graphs.
 """
 class FilterExpressionAccessor(object):
     def __init__(self, expressions, random = False):
-        self._expressions = expressions
+        self._expressions = tuple(expressions)
         self._random = random
     
     def get_expression(self, iteration):
-        if self._expressions == 0:
+        if len(self._expressions) == 0:
             return None
-        elif self._expressions == 1:
+        elif len(self._expressions) == 1:
             return self._expressions[0]
         elif self._random == True:
             return self._randomize(iteration)
         else:
             return self._alternate(iteration)
+
+    # Returns the number of iterations after which the expressions repeat or None if they are random.
+    def get_period(self):
+        return None if self._random == True and len(self._expressions) > 1 else max(len(self._expressions), 1)
         
     def _alternate(self, iteration):
         return self._expressions[iteration % len(self._expressions)]
 
     def _randomize(self, iteration):
-        random.shuffle(self._expressions)
-        return next(iter(self._expressions))
+        return random.choice(self._expressions)
 
 """
-    Combining expressions accessor
+    Combining expressions accessor. Joined expressions are memoized for every iteration of the period of
+    the combined accessors.
 """
 class CombiningExpressionAccessor(FilterExpressionAccessor):
     def __init__(self, accessors):
-        self._accessors = accessors
+        self._accessors = tuple(accessors)
+        self._period = 1
+        for a in self._accessors:
+            period = a.get_period()
+            self._period = self._period * period / gcd(self._period, period) if period and self._period else None
+        self._joined = {}
     
     def get_expression(self, iteration):
-        return ",".join([a.get_expression(iteration) for a in self._accessors])
+        if self._period == None:
+            return ",".join([a.get_expression(iteration) for a in self._accessors])
+        key = iteration % self._period
+        if key not in self._joined:
+            self._joined[key] = ",".join([a.get_expression(key) for a in self._accessors])
+        return self._joined[key]
+
+    def get_period(self):
+        return self._period
 
 """
     Base class for filters
@@ -42,17 +63,20 @@ class Filter(object):
     def __init__(self, outstreamprefix):
         self._outstreamprefix = outstreamprefix
 
-    def generate(self, streams):
+    def generate(self, streams, offset = 0):
         raise NotImplementedError("Subclasses should implement this!")
 
-    def _generate_base(self, streams, expression_accessor):
+    # Generates single filter per stream. Prefix of the output streams could be overridden, so the same filter
+    # could be applied to streams of different names. Offset is the index of the first stream in the whole
+    # slideshow, so alternating expressions continue across graphs rendering its parts.
+    def _generate_base(self, streams, expression_accessor, outstreamprefix = None, offset = 0):
         i = 0
         newstreams = []
         output = []
         for s in streams:
-            newstream = self._outstreamprefix
+            newstream = outstreamprefix if outstreamprefix != None else self._outstreamprefix
             if i > 0: newstream += str(i)
-            output.append("[{s}]{e}[{ns}]".format(s = s, e = expression_accessor.get_expression(i), ns = newstream))
+            output.append("[{s}]{e}[{ns}]".format(s = s, e = expression_accessor.get_expression(offset + i), ns = newstream))
             newstreams.append(newstream)
             i += 1
         return output, newstreams
@@ -77,8 +101,8 @@ class CombiningFilter(Filter, Combinable):
         Filter.__init__(self, outstreamprefix)
         Combinable.__init__(self, CombiningExpressionAccessor([c.get_accessor() for c in combinables]))
 
-    def generate(self, streams):
-        return self._generate_base(streams, self.get_accessor())
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self.get_accessor(), offset = offset)
 
 
 """
@@ -91,8 +115,8 @@ class DurationFilter(Filter, Combinable):
             "trim=duration={dt}".format(dt = duration)
         ]))
 
-    def generate(self, streams):
-        return self._generate_base(streams, self.get_accessor())
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self.get_accessor(), offset = offset)
 
 
 """
@@ -105,8 +129,8 @@ class ScaleFilter(Filter, Combinable):
             "scale={w}:{h}".format(w = width, h = height)
         ]))
 
-    def generate(self, streams):
-        return self._generate_base(streams, self.get_accessor())
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self.get_accessor(), offset = offset)
 
 
 """
@@ -119,16 +143,34 @@ class SARPTSFilter(Filter, Combinable):
             "setsar=1:1,setpts=PTS-STARTPTS"
         ]))
 
-    def generate(self, streams):
-        return self._generate_base(streams, self.get_accessor())
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self.get_accessor(), offset = offset)
+
+
+"""
+    Still image filter. Repeats the single decoded frame of a still image input endlessly instead of
+    demuxing and decoding the image file for every frame with -loop 1.
+"""
+class StillImageFilter(Filter, Combinable):
+    def __init__(self, fps, outstreamprefix="sif"):
+        Filter.__init__(self, outstreamprefix)
+        Combinable.__init__(self, FilterExpressionAccessor([
+            "loop=loop=-1:size=1:start=0,setpts=N/({fps}*TB)".format(fps = fps)
+        ]))
+
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self.get_accessor(), offset = offset)
 
 
 """
-    Basic image slide filter
+    Basic image slide filter. Scaling is skipped for prescaled inputs that already have the output size.
 """
 class ImageSlideFilter(CombiningFilter):
-    def __init__(self, duration, width, height, outstreamprefix="isf"):
-        CombiningFilter.__init__(self, [DurationFilter(duration), ScaleFilter(width, height), SARPTSFilter()], outstreamprefix)
+    def __init__(self, duration, width, height, outstreamprefix="isf", prescaled=False):
+        if prescaled == True:
+            CombiningFilter.__init__(self, [DurationFilter(duration), SARPTSFilter()], outstreamprefix)
+        else:
+            CombiningFilter.__init__(self, [DurationFilter(duration), ScaleFilter(width, height), SARPTSFilter()], outstreamprefix)
 
 
 """
@@ -140,7 +182,7 @@ class ConcatFilter(Filter):
         self._is_video = is_video
         self._outputtag = outputtag
 
-    def generate(self, streams):
+    def generate(self, streams, offset = 0):
         tags = "".join(["[%s]" % s for s in streams])
         return  ["{t}concat=n={c}:v={vo}:a={ao}[{ot}]".format(
             t=tags, 
@@ -155,17 +197,17 @@ class ConcatFilter(Filter):
     Chain of filters executed sequentially
 """
 class FilterChain(Filter):
-    def __init__(self, filters = []):
-        self._filters = filters
+    def __init__(self, filters = None):
+        self._filters = list(filters) if filters else []
 
     def append(self, filter):
         self._filters.append(filter)
 
-    def generate(self, streams):
+    def generate(self, streams, offset = 0):
         output = []
         newstreams = streams
         for f in self._filters:
-            res = f.generate(newstreams)
+            res = f.generate(newstreams, offset)
             output += res[0]
             newstreams = res[1]
         return output, newstreams
@@ -177,13 +219,14 @@ class VideoSplitFilter(Filter):
     def __init__(self, count, outstreamprefix = "vsf"):
         super(self.__class__, self).__init__(outstreamprefix = outstreamprefix)
         self._count = count
-        self._names = ['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h', 'i', 'j', 'k', 'l', 'm', 'n', 'o', 'p', 'q', 'r', 's', 't', 'u', 'v', 'x', 'y', 'z']
+        # the first outputs are named by single letter, the next ones get the number of the round as suffix
+        self._names = [SPLIT_NAMES[i % len(SPLIT_NAMES)] + (str(i / len(SPLIT_NAMES)) if i >= len(SPLIT_NAMES) else "") for i in range(0, count)]
 
-    def generate(self, streams):
+    def generate(self, streams, offset = 0):
         output = []
         newstreams = []
         for s in streams:
-            new = [self._outstreamprefix + self._names[i] for i in range(0,self._count)]
+            new = [self._outstreamprefix + n for n in self._names]
             newstreams += new
             output.append("[{s}]split={c}{ns}".format(
                 s = s,
@@ -10,19 +10,30 @@ class ZoompanType(IntEnum):
     alternate = (zoom_in[0] | zoom_out[0]),
     random = (alternate[0] | 1 << 0)
 
+"""
+    Panzoom effect filter. If oversample factor and the output size are passed, the image is first scaled to
+    oversample times the output size and zoompan renders frames of the output size from it, so every frame is
+    cropped from a small image instead of the full source image. Higher factors give smoother motion.
+"""
 class ZoompanEffectFilter(Filter, Combinable):
-    def __init__(self, maxzoom, frames, type = ZoompanType.alternate, outstreamprefix="pzf"):
+    def __init__(self, maxzoom, frames, type = ZoompanType.alternate, outstreamprefix="pzf", fps = None, width = None, height = None, oversample = None):
         expressions = []
         step = (maxzoom - 1.0) / frames
+        # zoompan outputs 25 fps unless other frame rate is set
+        rate = ":fps={fps}".format(fps = fps) if fps else ""
+        scale = ""
+        if oversample and width > 0 and height > 0:
+            scale = "scale={sw}:{sh},".format(sw = int(width * oversample)/2*2, sh = int(height * oversample)/2*2)
+            rate += ":s={w}x{h}".format(w = width, h = height)
         if isinstance(type, ZoompanType) == False:
             type = ZoompanType.alternate
         if type & ZoompanType.zoom_in == ZoompanType.zoom_in:
-            expressions.append("zoompan=z='min(zoom+{s},{mz})':d={df}".format(df = frames, s = step, mz = maxzoom))
+            expressions.append("{sc}zoompan=z='min(zoom+{s},{mz})':d={df}{r}".format(sc = scale, df = frames, s = step, mz = maxzoom, r = rate))
         if type & ZoompanType.zoom_out == ZoompanType.zoom_out:
-            expressions.append("zoompan=z='if(lte(zoom,1.0),{mz},max(1.001,zoom-{s}))':d={df}".format(df = frames, s = step, mz = maxzoom))
+            expressions.append("{sc}zoompan=z='if(lte(zoom,1.0),{mz},max(1.001,zoom-{s}))':d={df}{r}".format(sc = scale, df = frames, s = step, mz = maxzoom, r = rate))
 
         Filter.__init__(self, outstreamprefix)
         Combinable.__init__(self, FilterExpressionAccessor(expressions, type == ZoompanType.random))
 
-    def generate(self, streams):
-        return self._generate_base(streams, self.get_accessor())
\ No newline at end of file
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self.get_accessor(), offset = offset)
\ No newline at end of file
@@ -0,0 +1,193 @@
+import re
+
+NOOP_FILTERS = ["null", "anull"]
+IDEMPOTENT_FILTERS = ["setsar", "setdar", "format", "aformat"]
+# filters that are idempotent only with arguments matching the pattern, e.g. timestamps reset or scale to fixed size
+IDEMPOTENT_ARGUMENTS = {
+    "setpts": r"PTS-STARTPTS$",
+    "asetpts": r"PTS-STARTPTS$",
+    "scale": r"(w=)?[1-9][0-9]*:(h=)?[1-9][0-9]*(:flags=\w+)?$"
+}
+SPLIT_FILTERS = ["split", "asplit"]
+
+"""
+    Filter graph optimizer. Receives the list of filter chains generated by the filters (e.g. "[0:v]trim=duration=5,
+    scale=1200:800[isf]") and returns equivalent, cheaper list of chains and statistics of the graph before and after
+    the optimization. Labels listed in keep (e.g. the mapped outputs) are preserved.
+    The optimizer drops no-op filters, removes repeated idempotent filters, hoists filters common to all outputs of
+    split above it and merges chains that feed single consumer into it.
+"""
+def optimize_graph(filters, keep = None):
+    keep = keep or []
+    chains = [_parse_chain(f) for f in filters]
+    before = _graph_stats(chains)
+
+    chains = _remove_empty(chains, keep)
+    for c in chains:
+        c["filters"] = _dedupe(_drop_noops(c["filters"]))
+    chains = _hoist_above_splits(chains, keep)
+    chains = _merge_linear(chains, keep)
+    # merged chains could bring repeated or no-op filters together
+    for c in chains:
+        c["filters"] = _dedupe(_drop_noops(c["filters"]))
+
+    return [_format_chain(c) for c in chains], {"before": before, "after": _graph_stats(chains)}
+
+
+"""
+    Private method that parses chain string into dictionary with input labels, filters and output labels.
+"""
+def _parse_chain(chain):
+    inputs = re.match(r"^((?:\[[^\]]+\])*)", chain).group(1)
+    outputs = re.search(r"((?:\[[^\]]+\])*)$", chain[len(inputs):]).group(1)
+    body = chain[len(inputs):len(chain) - len(outputs)]
+    return {"inputs": re.findall(r"\[([^\]]+)\]", inputs), "filters": _split_filters(body), "outputs": re.findall(r"\[([^\]]+)\]", outputs)}
+
+
+"""
+    Private method that splits chain body into filters by the commas that are neither escaped nor quoted.
+"""
+def _split_filters(body):
+    if "'" not in body and "\\" not in body:
+        return [f for f in body.split(",") if f]
+    filters = []
+    current = ""
+    quoted = False
+    escaped = False
+    for ch in body:
+        if escaped:
+            escaped = False
+        elif ch == "\\":
+            escaped = True
+        elif ch == "'":
+            quoted = not quoted
+        elif ch == "," and not quoted:
+            filters.append(current)
+            current = ""
+            continue
+        current += ch
+    if current: filters.append(current)
+    return filters
+
+
+def _format_chain(chain):
+    return "".join(["[%s]" % s for s in chain["inputs"]]) + ",".join(chain["filters"]) + "".join(["[%s]" % s for s in chain["outputs"]])
+
+
+def _filter_name(filter):
+    return filter.split("=", 1)[0].split("@", 1)[0].strip()
+
+
+"""
+    Private method that returns number of filters (nodes), links between them (edges) and filter chains.
+"""
+def _graph_stats(chains):
+    nodes = sum([len(c["filters"]) for c in chains])
+    edges = sum([max(len(c["filters"]) - 1, 0) + len(c["inputs"]) for c in chains])
+    return {"nodes": nodes, "edges": edges, "chains": len(chains)}
+
+
+def _is_noop(filter):
+    return _filter_name(filter) in NOOP_FILTERS
+
+
+# Returns True if applying the filter twice gives the same result as applying it once.
+def _is_idempotent(filter):
+    name = _filter_name(filter)
+    if name in IDEMPOTENT_FILTERS:
+        return True
+    arguments = filter.split("=", 1)[1].strip() if "=" in filter else ""
+    return name in IDEMPOTENT_ARGUMENTS and re.match(IDEMPOTENT_ARGUMENTS[name], arguments) != None
+
+
+# Returns the filters without the no-op ones, unless the chain consists only of them.
+def _drop_noops(filters):
+    return [f for f in filters if not _is_noop(f)] or filters
+
+
+"""
+    Private method that removes filters repeating the previous idempotent filter with the same arguments.
+"""
+def _dedupe(filters):
+    result = []
+    for f in filters:
+        if result and result[-1] == f and _is_idempotent(f):
+            continue
+        result.append(f)
+    return result
+
+
+"""
+    Private method that removes chains consisting only of no-op filters by renaming the label they produce to the one
+    they consume. Chains producing labels that must be kept stay in the graph.
+"""
+def _remove_empty(chains, keep):
+    result = []
+    renames = {}
+    for c in chains:
+        if all([_is_noop(f) for f in c["filters"]]) and len(c["inputs"]) == 1 and len(c["outputs"]) == 1 and c["outputs"][0] not in keep:
+            renames[c["outputs"][0]] = c["inputs"][0]
+        else:
+            result.append(c)
+    for c in result:
+        c["inputs"] = [_resolve(s, renames) for s in c["inputs"]]
+    return result
+
+
+def _resolve(label, renames):
+    while label in renames:
+        label = renames[label]
+    return label
+
+
+"""
+    Private method that moves the leading filters shared by all consumers of split outputs in front of the split, so
+    they are executed once instead of once per output.
+"""
+def _hoist_above_splits(chains, keep):
+    consumers = _consumers(chains)
+    for c in chains:
+        if len(c["outputs"]) < 2 or _filter_name(c["filters"][-1]) not in SPLIT_FILTERS or any([o in keep for o in c["outputs"]]):
+            continue
+        targets = [consumers.get(o, []) for o in c["outputs"]]
+        if any([len(t) != 1 or len(t[0]["inputs"]) != 1 for t in targets]):
+            continue
+        targets = [t[0] for t in targets]
+        # every consumer keeps at least one filter after the hoisting
+        while all([len(t["filters"]) > 1 for t in targets]) and len(set([t["filters"][0] for t in targets])) == 1:
+            c["filters"].insert(len(c["filters"]) - 1, targets[0]["filters"][0])
+            for t in targets:
+                t["filters"].pop(0)
+    return chains
+
+
+"""
+    Private method that merges every chain with single output into the chain consuming it if that is its only input.
+    Chains are merged in single pass, the chain that absorbed others is looked up in merged.
+"""
+def _merge_linear(chains, keep):
+    consumers = _consumers(chains)
+    merged = {}
+    for c in chains:
+        if len(c["outputs"]) != 1 or c["outputs"][0] in keep:
+            continue
+        targets = consumers.get(c["outputs"][0], [])
+        if len(targets) != 1:
+            continue
+        target = targets[0]
+        while id(target) in merged:
+            target = merged[id(target)]
+        if len(target["inputs"]) != 1:
+            continue
+        target["inputs"] = c["inputs"]
+        target["filters"] = c["filters"] + target["filters"]
+        merged[id(c)] = target
+    return [c for c in chains if id(c) not in merged]
+
+
+def _consumers(chains):
+    consumers = {}
+    for c in chains:
+        for s in c["inputs"]:
+            consumers.setdefault(s, []).append(c)
+    return consumers
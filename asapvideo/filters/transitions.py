@@ -14,8 +14,8 @@ class FadeTransitionFilter(Filter, Combinable):
             "fade=t=in:st=0:d={tt},fade=t=out:st={te}:d={tt}".format(tt = transition_duration, te = total_duration - transition_duration)
         ]))
 
-    def generate(self, streams):
-        return self._generate_base(streams, self.get_accessor())
+    def generate(self, streams, offset = 0):
+        return self._generate_base(streams, self.get_accessor(), offset = offset)
 
 
 """
@@ -51,7 +51,7 @@ class SlidingOverlayFilter(Filter):
             expressions.append("overlay=y='max(h-(t*h/{td})\,0)':shortest=1".format(td = transition_duration))
         self._expressions_accessor = FilterExpressionAccessor(expressions, type == SlideTransitionType.random)
         
-    def generate(self, streams):
+    def generate(self, streams, offset = 0):
         newstreams = []
         output = []
         i = 0
@@ -62,7 +62,7 @@ class SlidingOverlayFilter(Filter):
                 "[{b}][{o}]{e}[{ns}]".format(
                     b = s1, 
                     o = s2,
-                    e = self._expressions_accessor.get_expression(i),
+                    e = self._expressions_accessor.get_expression(offset + i),
                     ns = newstream)
             )
             newstreams.append(newstream)
@@ -80,7 +80,7 @@ class SlideTransitionFilter(Filter):
         self._preserve_first = preserve_first
         self._transition_duration = transition_duration
 
-    def generate(self, streams):
+    def generate(self, streams, offset = 0):
         newstreams = []
         output = []
         splits = {}
@@ -99,7 +99,7 @@ class SlideTransitionFilter(Filter):
             slides.append(splitprev[1] if splitprev else sprev)
             slides.append(split[0] if split else s)
             sprev = s
-        trans = SlidingOverlayFilter(self._transition_duration, self._type).generate(slides)
+        trans = SlidingOverlayFilter(self._transition_duration, self._type).generate(slides, offset)
         return output + trans[0], newstreams + trans[1]
 
 
@@ -107,8 +107,9 @@ class SlideTransitionFilter(Filter):
     Class that renders zoompan plus slide in transition filters
 """
 class ZoompanSlideInTransitionFilter(Filter):
-    def __init__(self, transition_duration, total_duration, fps, width, height, maxzoom, preserve_first, type = SlideTransitionType.alternate, outstreamprefix="ftf"):
+    def __init__(self, transition_duration, total_duration, fps, width, height, maxzoom, preserve_first, type = SlideTransitionType.alternate, outstreamprefix="ftf", prescaled = False, oversample = None, preserve_last = True):
         Filter.__init__(self, outstreamprefix)
+        self._prescaled = prescaled
         self._transition_duration = transition_duration
         self._total_duration = total_duration
         self._width = width
@@ -116,50 +117,60 @@ class ZoompanSlideInTransitionFilter(Filter):
         self._maxzoom = maxzoom
         self._slide_duration = total_duration - transition_duration
         self._frames = int(math.ceil(self._slide_duration * fps))
+        self._fps = fps
         self._preserve_first = preserve_first
+        # the last slide ends with its transition out part only if no other part of the video continues from it
+        self._preserve_last = preserve_last
         self._type = type
+        # filters of the transition in, zoompan and transition out parts are shared by all slides
+        self._in = ImageSlideFilter(transition_duration, width, height, prescaled = prescaled)
+        self._zoompan = CombiningFilter([ZoompanEffectFilter(maxzoom, self._frames, fps = fps, width = width, height = height, oversample = oversample), ImageSlideFilter(self._slide_duration, width, height)], "z")
+        self._out = CombiningFilter([ZoompanEffectFilter(maxzoom, 1, fps = fps, width = width, height = height, oversample = oversample), ImageSlideFilter(transition_duration, width, height)], "z")
 
-    def generate(self, streams):
+    def generate(self, streams, offset = 0):
         output = []
         newstreams = []
         transitions = []
         parts = []
+        tail = [self._out] if self._preserve_last == True else []
 
-        s = streams[0]
         if self._preserve_first == True:
-            splitted = VideoSplitFilter(3, outstreamprefix = s.replace(":", "")).generate([s])
-            output += splitted[0]
-            a = ImageSlideFilter(self._transition_duration, self._width, self._height, splitted[1][0] + "z").generate(splitted[1][0:1])
-            output += a[0]
-            b = CombiningFilter([ZoompanEffectFilter(self._maxzoom, self._frames), ImageSlideFilter(self._slide_duration, self._width, self._height)], splitted[1][1] + "z").generate(splitted[1][1:2])
-            output += b[0]
-            c = CombiningFilter([ZoompanEffectFilter(self._maxzoom, 1), ImageSlideFilter(self._transition_duration, self._width, self._height)], splitted[1][2] + "z").generate(splitted[1][2:3])
-            output += c[0]
-            prev = (a[1][0], b[1][0], c[1][0])
-            newstreams += [a[1][0], b[1][0]]
-        else:                       
-            c = CombiningFilter([ZoompanEffectFilter(self._maxzoom, 1), ImageSlideFilter(self._transition_duration, self._width, self._height)], s.replace(":", "") + "z").generate([s])
-            output += c[0]
-            prev = (c[1][0], c[1][0], c[1][0])
+            slide = self._generate_slide(streams[0], [self._in, self._zoompan] + ([self._out] if len(streams) > 1 else tail))
+            newstreams += slide[1][:2]
+        else:
+            slide = self._generate_slide(streams[0], [self._out])
+        output += slide[0]
+        prev = slide[1]
 
-        for s in streams[1:]:
-            splitted = VideoSplitFilter(3, outstreamprefix = s.replace(":", "")).generate([s])
-            output += splitted[0]
-            a = ImageSlideFilter(self._transition_duration, self._width, self._height, splitted[1][0] + "z").generate(splitted[1][0:1])
-            output += a[0]
-            b = CombiningFilter([ZoompanEffectFilter(self._maxzoom, self._frames), ImageSlideFilter(self._slide_duration, self._width, self._height)], splitted[1][1] + "z").generate(splitted[1][1:2])
-            output += b[0]
-            c = CombiningFilter([ZoompanEffectFilter(self._maxzoom, 1), ImageSlideFilter(self._transition_duration, self._width, self._height)], splitted[1][2] + "z").generate(splitted[1][2:3])
-            output += c[0]
-            transitions += [prev[2], a[1][0]]
-            parts.append([b[1][0]])
-            prev = (a[1][0], b[1][0], c[1][0])
-
-        parts[-1].append(prev[2])
-        tran = SlidingOverlayFilter(self._transition_duration, self._type, "t").generate(transitions)
+        for i, s in enumerate(streams[1:], 1):
+            slide = self._generate_slide(s, [self._in, self._zoompan] + ([self._out] if i < len(streams) - 1 else tail))
+            output += slide[0]
+            transitions += [prev[-1], slide[1][0]]
+            parts.append([slide[1][1]])
+            prev = slide[1]
+
+        tran = SlidingOverlayFilter(self._transition_duration, self._type, "t").generate(transitions, offset)
         output += tran[0]
         t = iter(tran[1])
         for p in parts:
             newstreams.append(next(t))
             newstreams += p
-        return output, newstreams
\ No newline at end of file
+        if self._preserve_last == True:
+            newstreams.append(prev[-1])
+        return output, newstreams
+
+    # Generates the passed parts (in, zoompan, out) of the slide, the stream is split if there are more of them.
+    def _generate_slide(self, stream, filters):
+        if len(filters) == 1:
+            return filters[0]._generate_base([stream], filters[0].get_accessor(), stream.replace(":", "") + "z")
+        splitted = VideoSplitFilter(len(filters), outstreamprefix = stream.replace(":", "")).generate([stream])
+        output = splitted[0]
+        newstreams = []
+        for f, split in zip(filters, splitted[1]):
+            part = self._generate_part(f, split)
+            output += part[0]
+            newstreams += part[1]
+        return output, newstreams
+
+    def _generate_part(self, filter, stream):
+        return filter._generate_base([stream], filter.get_accessor(), stream + "z")
\ No newline at end of file
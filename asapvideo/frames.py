@@ -0,0 +1,232 @@
+import math
+import collections
+from ffmpy import FFmpeg
+
+# numpy is optional, the frame generator is not available without it
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# directions of the slide transitions in the order used by SlidingOverlayFilter for alternate type
+SLIDE_DIRECTIONS = ["left_right", "top_bottom", "right_left", "bottom_top"]
+
+# decoded images kept by the frame generator, the previous slide and the current one
+DECODED_IMAGES = 2
+
+"""
+    Frame generator that renders the slideshow animations in python instead of ffmpeg filter graph. The zoom, pan and
+    slide trajectories of every slide are precomputed as arrays and the frames are produced from a single decoded
+    copy of every image with vectorized crop, resize and composite operations. The frames are returned as rgb24 raw
+    video to be piped into the encoder. The animations match the ones of the filters: zoompan is anchored in the top
+    left corner and alternates zoom in and out, slide transitions alternate their directions.
+"""
+class FrameGenerator(object):
+    def __init__(self, width, height, fps, ffmpeg, oversample = 1, interpolation = "bilinear"):
+        self.width = width
+        self.height = height
+        self._fps = fps
+        self._ffmpeg = ffmpeg
+        self._oversample = oversample
+        self._interpolation = interpolation
+        self._images = collections.OrderedDict()
+
+    # Resolves the output size if it should preserve the aspect ratio of the first image (width or height is -2).
+    def resolve_size(self, image):
+        if self.width <= 0 or self.height <= 0:
+            frame = self._decode(image, self.width, self.height)
+            self.height, self.width = frame.shape[0], frame.shape[1]
+        return self.width, self.height
+
+    # Returns input options of the raw video produced by generate.
+    def get_input_options(self):
+        return "-f rawvideo -pix_fmt rgb24 -s {w}x{h} -framerate {fps}".format(w = self.width, h = self.height, fps = self._fps)
+
+    # Generates raw frames of the whole video, animation is effect and transition names joined as in the
+    # animations of the filter graph. Offset is the index of the first image in the whole slideshow, so the
+    # alternating zoom and slide directions continue across the rendered parts. The last slide of zoompan slide in
+    # zooms out only if preserve_last, the rendered part is not continued.
+    def generate(self, images, animation, scene_duration, transition_duration, maxzoom, preserve_first, offset = 0, preserve_last = True):
+        self.resolve_size(images[0])
+        scene_frames = int(round(scene_duration * self._fps))
+        if animation == "slidein":
+            frames = self._generate_slidein(images, scene_frames, transition_duration, preserve_first, offset)
+        elif animation == "zoompanslidein":
+            frames = self._generate_zoompanslidein(images, scene_duration, transition_duration, maxzoom, preserve_first, offset, preserve_last)
+        else:
+            frames = self._generate_slides(images, animation, scene_frames, transition_duration, maxzoom, offset)
+        return _raw(frames)
+
+    def _generate_slides(self, images, animation, scene_frames, transition_duration, maxzoom, offset):
+        fade_frames = int(round(transition_duration * self._fps)) if animation in ["fadeinout", "zoompanfadeinout"] else 0
+        for i, image in enumerate(images):
+            if animation in ["zoompan", "zoompanfadeinout"]:
+                frames = self._zoom(image, zoom_trajectory(maxzoom, scene_frames, (offset + i) % 2 == 0))
+            else:
+                frames = self._still(image, scene_frames)
+            for f, frame in enumerate(frames):
+                if fade_frames:
+                    frame = _fade(frame, f, scene_frames, fade_frames)
+                yield frame
+
+    def _generate_slidein(self, images, scene_frames, transition_duration, preserve_first, offset):
+        if preserve_first == True:
+            for frame in self._still(images[0], scene_frames):
+                yield frame
+        for i in range(1, len(images)):
+            base = self._zoom_frame(self._image(images[i - 1]), 1.0)
+            for frame in self._slide(base, self._zoom_frame(self._image(images[i]), 1.0), scene_frames, transition_duration, offset + i - 1):
+                yield frame
+
+    def _generate_zoompanslidein(self, images, scene_duration, transition_duration, maxzoom, preserve_first, offset, preserve_last):
+        transition_frames = int(round(transition_duration * self._fps))
+        slide_frames = int(math.ceil((scene_duration - transition_duration) * self._fps))
+        zooms = zoom_trajectory(maxzoom, slide_frames, True)
+        if preserve_first == True:
+            for frame in self._still(images[0], transition_frames):
+                yield frame
+            for frame in self._zoom(images[0], zooms):
+                yield frame
+        for i in range(1, len(images)):
+            # the previous slide stays at its max zoom while the next one slides in
+            base = self._zoom_frame(self._image(images[i - 1]), maxzoom)
+            for frame in self._slide(base, self._zoom_frame(self._image(images[i]), 1.0), transition_frames, transition_duration, offset + i - 1):
+                yield frame
+            for frame in self._zoom(images[i], zooms):
+                yield frame
+        if preserve_last == True:
+            last = self._zoom_frame(self._image(images[-1]), maxzoom)
+            for _ in range(0, transition_frames):
+                yield last
+
+    def _still(self, image, count):
+        frame = self._zoom_frame(self._image(image), 1.0)
+        for _ in range(0, count):
+            yield frame
+
+    def _zoom(self, image, zooms):
+        source = self._image(image)
+        for z in zooms:
+            yield self._zoom_frame(source, z)
+
+    # Crops 1/zoom of the image from its top left corner and resizes it to the output size. Bilinear interpolation
+    # uses 8 bit fixed point weights, nearest is much faster and looks well on oversampled images.
+    def _zoom_frame(self, source, zoom):
+        sh, sw = source.shape[0], source.shape[1]
+        if sw == self.width and sh == self.height and zoom == 1.0:
+            return source
+        ys = numpy.clip((numpy.arange(self.height, dtype = numpy.float32) + 0.5) * (sh / zoom / self.height) - 0.5, 0, sh - 1)
+        xs = numpy.clip((numpy.arange(self.width, dtype = numpy.float32) + 0.5) * (sw / zoom / self.width) - 0.5, 0, sw - 1)
+        if self._interpolation == "nearest":
+            return numpy.take(numpy.take(source, numpy.rint(ys).astype(numpy.intp), axis = 0), numpy.rint(xs).astype(numpy.intp), axis = 1)
+        y0, y1, wy = _bilinear_indices(ys, sh)
+        x0, x1, wx = _bilinear_indices(xs, sw)
+        # only the columns of the cropped area are interpolated
+        cropped = source[:, :x1[-1] + 1]
+        rows = (numpy.take(cropped, y0, axis = 0) * (256 - wy)[:, None, None] + numpy.take(cropped, y1, axis = 0) * wy[:, None, None]) >> 8
+        frame = (numpy.take(rows, x0, axis = 1) * (256 - wx)[None, :, None] + numpy.take(rows, x1, axis = 1) * wx[None, :, None]) >> 8
+        return frame.astype(numpy.uint8)
+
+    # Composites frames of the next slide sliding in over the base frame.
+    def _slide(self, base, frame, count, transition_duration, iteration):
+        direction = SLIDE_DIRECTIONS[iteration % len(SLIDE_DIRECTIONS)]
+        size = self.width if direction in ["left_right", "right_left"] else self.height
+        for offset in slide_trajectory(numpy.arange(count) / float(self._fps), transition_duration, size, direction):
+            if offset == 0:
+                yield frame
+                continue
+            result = base.copy()
+            if direction in ["left_right", "right_left"]:
+                if offset < 0: result[:, :size + offset] = frame[:, -offset:]
+                else: result[:, offset:] = frame[:, :size - offset]
+            else:
+                if offset < 0: result[:size + offset] = frame[-offset:]
+                else: result[offset:] = frame[:size - offset]
+            yield result
+
+    # Returns the decoded image. Only the images of the current slide and the transition into it are kept, the
+    # animations never go back to older ones.
+    def _image(self, image):
+        size = (int(self.width * self._oversample) / 2 * 2, int(self.height * self._oversample) / 2 * 2)
+        key = (image, size)
+        source = self._images.pop(key, None)
+        if source is None:
+            source = self._decode(image, size[0], size[1])
+        self._images[key] = source
+        while len(self._images) > DECODED_IMAGES:
+            self._images.popitem(last = False)
+        return source
+
+    # Decodes the image scaled to the passed size with ffmpeg.
+    def _decode(self, image, width, height):
+        out = FFmpeg(
+            executable = self._ffmpeg,
+            global_options = ["-v", "error"],
+            inputs = {image: None},
+            outputs = {"-": "-vf scale={w}:{h} -frames:v 1 -f image2pipe -vcodec ppm".format(w = width, h = height)}
+        ).run()
+        return _parse_ppm(out)
+
+
+"""
+    Returns zoom of every frame of zoompan effect. The values follow the zoompan expressions of ZoompanEffectFilter.
+"""
+def zoom_trajectory(maxzoom, frames, zoom_in):
+    step = (maxzoom - 1.0) / frames
+    if zoom_in == True:
+        return numpy.minimum(1.0 + (numpy.arange(frames) + 1) * step, maxzoom)
+    return numpy.maximum(maxzoom - numpy.arange(frames) * step, 1.001)
+
+
+"""
+    Returns offsets of the sliding slide at the times in the passed array. The values follow the overlay expressions
+    of SlidingOverlayFilter.
+"""
+def slide_trajectory(times, transition_duration, size, direction):
+    if direction in ["left_right", "top_bottom"]:
+        return numpy.minimum(-size + times * size / transition_duration, 0).astype(int)
+    return numpy.maximum(size - times * size / transition_duration, 0).astype(int)
+
+
+"""
+    Converts frames to raw bytes. Still slides repeat the same frame, so its bytes are reused.
+"""
+def _raw(frames):
+    last = None
+    for frame in frames:
+        if frame is not last:
+            last = frame
+            data = frame.tobytes()
+        yield data
+
+
+# Returns lower and upper source indices and 8 bit weights of the upper ones.
+def _bilinear_indices(coords, size):
+    lower = numpy.floor(coords).astype(numpy.intp)
+    return lower, numpy.minimum(lower + 1, size - 1), ((coords - lower) * 256).astype(numpy.uint16)
+
+
+def _fade(frame, index, frames, fade_frames):
+    level = min(1.0, index / float(fade_frames), (frames - index) / float(fade_frames))
+    if level >= 1.0:
+        return frame
+    return (frame * level).astype(numpy.uint8)
+
+
+"""
+    Parses binary PPM image into height x width x 3 array.
+"""
+def _parse_ppm(data):
+    fields = []
+    pos = 0
+    while len(fields) < 4:
+        while data[pos].isspace(): pos += 1
+        if data[pos] == "#":
+            pos = data.index("\n", pos)
+            continue
+        end = pos
+        while not data[end].isspace(): end += 1
+        fields.append(data[pos:end])
+        pos = end
+    width, height = int(fields[1]), int(fields[2])
+    return numpy.frombuffer(data, numpy.uint8, width * height * 3, pos + 1).reshape((height, width, 3))
@@ -0,0 +1,295 @@
+import sys
+import time
+import threading
+import traceback
+import contextlib
+import collections
+from Queue import Queue
+import ffmpy
+
+# job running on the current thread, worker threads of the job inherit it
+_context = threading.local()
+
+"""
+    Raised by the job, its result and the work done on its behalf after the job is cancelled.
+"""
+class JobCancelled(Exception):
+    pass
+
+
+"""
+    Raised by the result of the job if it does not finish before the timeout expires.
+"""
+class JobTimeout(Exception):
+    pass
+
+
+"""
+    Job running function on a thread of JobExecutor. The result is waited for by result, cancel stops the job:
+    the job does not start if it is still queued, otherwise all ffmpeg processes it runs are killed and the
+    cancellation checkpoints (check_cancelled) raise JobCancelled.
+"""
+class Job(object):
+    def __init__(self, func, args, kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._started = False
+        self._cancelled = False
+        self._result = None
+        self._error = None
+        self._processes = []
+        self._callbacks = []
+
+    # Cancels the job. Returns False if the job already finished.
+    def cancel(self):
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._cancelled = True
+            started = self._started
+            processes = self._processes
+            self._processes = []
+        for p in processes:
+            _kill(p)
+        if not started:
+            self._finish(None, JobCancelled("Job cancelled before it started"))
+        return True
+
+    def cancelled(self):
+        return self._cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    # Waits for the job and returns its result or raises its error. Raises JobTimeout if the timeout expires.
+    def result(self, timeout = None):
+        if not self._done.wait(timeout):
+            raise JobTimeout("Job did not finish in %s seconds" % timeout)
+        if self._error != None:
+            raise self._error
+        return self._result
+
+    # Calls callback with the job when it finishes, immediately if it already finished.
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def _run(self):
+        with self._lock:
+            if self._cancelled:
+                return
+            self._started = True
+        set_current_job(self)
+        try:
+            result, error = self._func(*self._args, **self._kwargs), None
+        # the job has to finish whatever it raised, otherwise its result would wait forever
+        except BaseException as e:
+            result, error = None, e
+        finally:
+            set_current_job(None)
+        # killed processes fail with errors of their own
+        if self._cancelled and not isinstance(error, JobCancelled):
+            result, error = None, JobCancelled("Job cancelled")
+        self._finish(result, error)
+
+    def _finish(self, result, error):
+        with self._lock:
+            if self._done.is_set():
+                return
+            self._result = result
+            self._error = error
+            self._processes = []
+            callbacks = self._callbacks
+            self._callbacks = []
+            self._done.set()
+        for c in callbacks:
+            self._call(c)
+
+    # Calls the done callback, its errors are printed so they do not break the job or its worker thread.
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            print "Job done callback failed"
+            print traceback.format_exc(sys.exc_info())
+
+    def _track(self, process):
+        with self._lock:
+            if not self._cancelled:
+                self._processes = [p for p in self._processes if p.poll() == None] + [process]
+                return
+        _kill(process)
+        raise JobCancelled("Job cancelled")
+
+
+"""
+    Executor running submitted jobs on at most concurrency threads at the same time, the other jobs wait in queue
+    in the order they were submitted. Threads are started when needed.
+"""
+class JobExecutor(object):
+    def __init__(self, concurrency):
+        self._concurrency = concurrency
+        self._queue = Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    # Submits func to be called with the passed arguments and returns its Job.
+    def submit(self, func, *args, **kwargs):
+        job = Job(func, args, kwargs)
+        self._queue.put(job)
+        self._start_worker()
+        return job
+
+    def _start_worker(self):
+        with self._lock:
+            if len(self._threads) < self._concurrency:
+                t = threading.Thread(target = self._worker)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+
+    # Runs the queued jobs. The thread leaving the loop for any reason frees its place, so the queued jobs get
+    # another thread.
+    def _worker(self):
+        try:
+            while True:
+                self._queue.get()._run()
+        finally:
+            with self._lock:
+                self._threads.remove(threading.current_thread())
+            if not self._queue.empty():
+                self._start_worker()
+
+
+"""
+    Scheduler of local ffmpeg renders sharing the cores of the machine. Every render asks for a slot with its relative
+    cost (0 to 1, the most expensive animation has 1) and reserves its share of the cores, the most expensive renders
+    reserve max_threads. Renders are started in the order they asked while the shares of the running ones fit the
+    cores, a render that does not fit waits even if smaller ones behind it would, so expensive renders are not
+    starved. Single render is always started, even if its share is larger than the cores. Threads of the renders
+    are capped to their shares only under contention, render started while no other one runs or waits gets all
+    cores (up to max_threads).
+"""
+class RenderScheduler(object):
+    def __init__(self, cores, max_threads):
+        self._cores = cores
+        self._max_threads = max_threads
+        self._condition = threading.Condition()
+        self._queue = collections.deque()
+        self._threads = 0
+        self._running = 0
+        self._stats = {"completed": 0, "wait": 0.0, "max_wait": 0.0, "since": None}
+
+    # Returns the share of the cores (threads) of render of the passed relative cost.
+    def get_threads(self, cost):
+        return max(1, min(self._max_threads, int(round(self._max_threads * cost))))
+
+    # Waits until the render fits the free cores and returns its threads, the slot is freed by release.
+    def acquire(self, cost):
+        share = self.get_threads(cost)
+        ticket = object()
+        t = time.time()
+        with self._condition:
+            if self._stats["since"] == None: self._stats["since"] = t
+            self._queue.append(ticket)
+            try:
+                while self._queue[0] is not ticket or (self._running > 0 and self._threads + share > self._cores):
+                    # the timeout lets cancelled jobs stop waiting
+                    self._condition.wait(1)
+                    check_cancelled()
+            except:
+                self._queue.remove(ticket)
+                self._condition.notify_all()
+                raise
+            self._queue.popleft()
+            threads = share if self._running > 0 or self._queue else max(share, min(self._cores, self._max_threads))
+            self._threads += share
+            self._running += 1
+            wait = time.time() - t
+            self._stats["wait"] += wait
+            self._stats["max_wait"] = max(self._stats["max_wait"], wait)
+            # the next render could fit the remaining cores
+            self._condition.notify_all()
+        return threads
+
+    # Frees the slot of render of the passed relative cost.
+    def release(self, cost):
+        with self._condition:
+            self._threads -= self.get_threads(cost)
+            self._running -= 1
+            self._stats["completed"] += 1
+            self._condition.notify_all()
+
+    # Context manager holding render slot, yields the threads of the render.
+    @contextlib.contextmanager
+    def slot(self, cost):
+        threads = self.acquire(cost)
+        try:
+            yield threads
+        finally:
+            self.release(cost)
+
+    # Returns dictionary with the number of waiting (queued) and running renders, the threads they reserve, the number
+    # of completed renders, average and maximal wait for slot in seconds and throughput in renders per minute.
+    def stats(self):
+        with self._condition:
+            completed = self._stats["completed"]
+            started = completed + self._running
+            elapsed = time.time() - self._stats["since"] if self._stats["since"] != None else 0
+            return {
+                "queued": len(self._queue),
+                "running": self._running,
+                "threads": self._threads,
+                "cores": self._cores,
+                "completed": completed,
+                "wait": self._stats["wait"] / started if started else 0.0,
+                "max_wait": self._stats["max_wait"],
+                "throughput": completed * 60.0 / elapsed if elapsed > 0 else 0.0
+            }
+
+
+"""
+    Returns the job running on the current thread or None.
+"""
+def current_job():
+    return getattr(_context, "job", None)
+
+
+"""
+    Sets the job of the current thread, threads doing work of a job (e.g. parallel downloads) set the job of the
+    thread that started them, so they could be cancelled with it.
+"""
+def set_current_job(job):
+    _context.job = job
+
+
+"""
+    Cancellation checkpoint. Raises JobCancelled if the job of the current thread is cancelled.
+"""
+def check_cancelled():
+    job = current_job()
+    if job != None and job.cancelled():
+        raise JobCancelled("Job cancelled")
+
+
+# Registers ffmpeg process started by the current thread with its job.
+def _track_process(process):
+    job = current_job()
+    if job != None:
+        job._track(process)
+
+
+def _kill(process):
+    try:
+        if process.poll() == None: process.kill()
+    except OSError:
+        pass
+
+
+ffmpy.PROCESS_LISTENERS.append(_track_process)
@@ -7,8 +7,13 @@ import shutil
 import math
 import json
 import traceback
+import decimal
 
-BATCH_SIZE = 20
+# batches are sized so that their render takes about TARGET_BATCH_T seconds by asapvideo.RENDER_COSTS, the target
+# leaves room for the estimates, 1200x800 zoompan batches get no more images than the former fixed batches of 20
+TARGET_BATCH_T = 60
+MIN_BATCH_SIZE = 5
+MAX_BATCH_SIZE = 60
 BATCHES_SNS_TOPIC = 'arn:aws:sns:us-east-1:419956479724:asapvideo-batches'
 S3_BUCKET = 'asapvideo'
 DYNAMODB_TABLE = 'asapvideo'
@@ -18,7 +23,7 @@ DYNAMODB_TABLE = 'asapvideo'
     It is intended to be used with DynamoDB streams with a batch size of 1.
 """
 def process_request_handler(event, context):
-    # First part of the function is reposnible for splitting the list of images into batches of BATCH_SIZE number of items.
+    # First part of the function is reposnible for splitting the list of images into batches sized by the render cost of the requested animation.
     # Lambda could be set to be triggered on more than one records at a time, so tht's why we assume that is the case.
     # We iterate through all new records and split their list of images into batches.
     for record in [r['dynamodb']['NewImage'] for r in event['Records'] if r['eventName'] == 'INSERT' and 'urls' in r['dynamodb']['NewImage']]:
@@ -29,24 +34,31 @@ def process_request_handler(event, context):
         height = int(record['height']['N']) if 'height' in record else None
         transition = record['transition']['S'] if 'transition' in record else None
         effect = record['effect']['S'] if 'effect' in record else None
-        batches = int(math.ceil(len(list) / float(BATCH_SIZE)))
+        profile = record['profile']['S'] if 'profile' in record else None
+        size = get_batch_size(scene_duration, width, height, effect, transition)
+        sizes = split_batches(len(list), size)
+        batches = len(sizes)
         
         if batches == 0:
             update_record(id, {"sts": "processed"})
         else:
-            update_record(id, {"sts": "processing", "batches": {"count": batches}})
+            # every batch but the first one starts with the last image of the previous batch, which is not rendered again
+            starts = [sum(sizes[:i]) for i in range(0, batches)]
+            durations = [scene_duration * s for s in sizes]
+            update_record(id, {"sts": "processing", "batches": {"count": batches, "size": size, "sizes": sizes, "durations": durations}})
             sns = boto3.client('sns')
             for i in range(0, batches):
                 # every batch is sent to the BATCHES_SNS_TOPIC SNS topic
                 message = json.dumps(clear_dict({
                     "id": id,
                     "batch": i + 1,
-                    "urls": list[max((i*BATCH_SIZE)-1, 0):(i+1)*BATCH_SIZE],
+                    "urls": list[max(starts[i]-1, 0):starts[i]+sizes[i]],
                     "scene_duration": scene_duration,
                     "width": width,
                     "height": height,
                     "transition": transition,
                     "effect": effect,
+                    "profile": profile,
                     "audio": False
                 }), separators=(',', ':'))
                 response = sns.publish(
@@ -68,12 +80,23 @@ def process_request_handler(event, context):
                 if not os.path.exists(outdir):
                     os.makedirs(outdir)
 
-                # concatenate all outputs
+                # batches report the duration they rendered, which is shorter than the planned one if some images failed to download
+                outputs = sorted(record['batches']['M']['outputs']['L'], key=lambda output: int(output['M']['batch']['N']))
+                if all(['duration' in o['M'] for o in outputs]):
+                    durations = [float(o['M']['duration']['N']) for o in outputs]
+                elif 'durations' in record['batches']['M']:
+                    durations = [int(d['N']) for d in record['batches']['M']['durations']['L']]
+                else:
+                    durations = None
+
+                # concatenate all outputs, they are read straight from S3 while muxing
                 file = asapvideo.concat_videos(
-                    [o['M']['output']['S'] for o in sorted(record['batches']['M']['outputs']['L'], key=lambda output: int(output['M']['batch']['N']))],
+                    [o['M']['output']['S'] for o in outputs],
                     outdir = outdir,
                     ffmpeg = get_ffmpeg(),
-                    audio = True
+                    audio = True,
+                    stream = True,
+                    durations = durations
                 )
 
                 # upload to s3 and modify the record for a last time
@@ -113,19 +136,40 @@ def process_batch_handler(event, context):
                 transition = record['transition'] if 'transition' in record else None,
                 effect = record['effect'] if 'effect' in record else None,
                 audio = bool(record['audio']) if 'audio' in record else True,
+                profile = record['profile'] if 'profile' in record else asapvideo.DEFAULT_ENCODER_PROFILE,
                 batch_mode = asapvideo.BatchMode.initial_batch if batch == 1 else asapvideo.BatchMode.non_initial_batch)
 
             if file == None:
                 raise Exception("No output video was created for request %s batch %d" % (id, batch))
 
+            # images that failed to download are left out of the batch, so its duration is read from the output
+            duration = asapvideo.get_duration(file, get_ffmpeg())
             video_url = upload_to_s3(file, "tmp/" + id + '/video' + str(batch))
-            add_output(id, batch, video_url)
+            add_output(id, batch, video_url, duration)
         except:
             print "Failed to make video for batch %d" % batch
             print traceback.format_exc(sys.exc_info())
             update_record(id, {"sts":"failed"})
 
 
+"""
+    Returns the number of images per batch, so that the batch renders in about TARGET_BATCH_T seconds. The render
+    time of an image is estimated from the per frame cost of the animation at the requested size.
+"""
+def get_batch_size(scene_duration, width, height, effect, transition):
+    image_t = asapvideo.get_render_cost(effect, transition, width, height) * scene_duration * asapvideo.FPS
+    return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, int(TARGET_BATCH_T / image_t)))
+
+
+"""
+    Splits count images into the least number of batches of at most size images and returns their sizes. The images
+    are spread evenly, so all batches take about the same time.
+"""
+def split_batches(count, size):
+    batches = int(math.ceil(count / float(size)))
+    return [count / batches + (1 if i < count % batches else 0) for i in range(0, batches)]
+
+
 """
     Uploads file to S3 bucket S3_BUCKET.
 """
@@ -154,15 +198,15 @@ def update_record(id, values):
 
 
 """
-    Adds batch output data to a DynamoDB record by passed id, batch number and output url.
+    Adds batch output data to a DynamoDB record by passed id, batch number, output url and duration in seconds.
 """
-def add_output(id, batch, output):
+def add_output(id, batch, output, duration):
     dynamodb = boto3.resource('dynamodb')
     table = dynamodb.Table(DYNAMODB_TABLE)
     table.update_item(
         Key={'id': id},
         UpdateExpression='SET batches.outputs=list_append(if_not_exists(batches.outputs, :l), :o)',
-        ExpressionAttributeValues={":l": [], ":o": [{"batch": batch, "output": output}]}
+        ExpressionAttributeValues={":l": [], ":o": [{"batch": batch, "output": output, "duration": decimal.Decimal(str(round(duration, 3)))}]}
     )
 
 
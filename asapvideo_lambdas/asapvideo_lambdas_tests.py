@@ -1,3 +1,6 @@
+import time
+import tempfile
+import asapvideo
 import asapvideo_lambdas
 
 def test_process_request_handler_with_newly_added_record():
@@ -195,5 +198,27 @@ def test_process_batch_handler():
     }
     asapvideo_lambdas.process_batch_handler(event, none)
 
+def benchmark_render_costs():
+    # renders a batch of every animation and prints the seconds per output frame to be set as asapvideo.RENDER_COSTS,
+    # it should run on the machine with the memory (and so the cores) of the batch lambda
+    urls = ["https://printastic-pdfpreview.imgix.net/796092bcda15-b7c91f455aea4ba698281cb3e0478e4a.pdf?page=%d" % i for i in range(1, 11)]
+    outdir = tempfile.mkdtemp()
+    ffmpeg = asapvideo_lambdas.get_ffmpeg()
+    # renders take all cores as in the batch lambda, the scheduler would cap their threads
+    scheduler, asapvideo.RENDER_SCHEDULER = asapvideo.RENDER_SCHEDULER, None
+    # the warm up render fills the download and normalization caches, so only the renders are measured
+    asapvideo.make_from_url_list(urls, 1, outdir, ffmpeg, audio = False)
+    animations = [(None, None), (None, "fadeinout"), (None, "slidein"), ("zoompan", None), ("zoompan", "fadeinout"), ("zoompan", "slidein")]
+    costs = {}
+    for effect, transition in animations:
+        t=time.time()
+        asapvideo.make_from_url_list(urls, asapvideo.SCENE_DURATION_T, outdir, ffmpeg, audio = False, effect = effect, transition = transition, batch_mode = asapvideo.BatchMode.initial_batch)
+        costs[(effect if effect else "") + (transition if transition else "")] = round((time.time() - t) / (len(urls) * asapvideo.SCENE_DURATION_T * asapvideo.FPS), 4)
+    print "RENDER_COSTS = %s" % costs
+    asapvideo.RENDER_SCHEDULER = scheduler
+    asapvideo.RENDER_COSTS = costs
+    for effect, transition in animations:
+        print "%s %s: %d images per batch" % (effect, transition, asapvideo_lambdas.get_batch_size(asapvideo.SCENE_DURATION_T, None, None, effect, transition))
+
 #if __name__ == "__main__":
 #    test_process_request_handler_with_newly_added_record()
\ No newline at end of file